@@ -0,0 +1,171 @@
+"""
+    Bottle CAS Server - Ticket stores for asyncio servers
+"""
+import asyncio
+from time import time
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from .TicketStore import (
+    GETDEL_ERRORS,
+    REDIS_CLAIM_SCRIPT,
+    REDIS_INDEX_ADD_SCRIPT,
+    as_ticket_store,
+    ticket_store_from_config,
+)
+
+
+class ThreadedTicketStore:
+    """ Any TicketStore, with its blocking calls run in an executor. """
+
+    def __init__(self, store, executor=None):
+
+        self.store = store
+        self.executor = executor
+
+    def _run(self, method, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: method(*args, **kwargs))
+
+    async def get(self, key):
+        return await self._run(self.store.get, key)
+
+    async def set(self, key, value, timeout=None):
+        return await self._run(self.store.set, key, value, timeout)
+
+    async def delete(self, key):
+        return await self._run(self.store.delete, key)
+
+    async def add(self, key, value, timeout=None):
+        return await self._run(self.store.add, key, value, timeout)
+
+    async def claim(self, key):
+        return await self._run(self.store.claim, key)
+
+    async def index_add(self, index, member, timeout=None):
+        return await self._run(self.store.index_add, index, member, timeout)
+
+    async def set_indexed(self, key, value, timeout, index, index_timeout=None):
+        return await self._run(self.store.set_indexed, key, value, timeout, index, index_timeout)
+
+    async def index_purge(self, *indexes, keys=()):
+        return await self._run(self.store.index_purge, *indexes, keys=keys)
+
+    async def aclose(self):
+        pass
+
+
+class AsyncRedisTicketStore:
+    """ RedisTicketStore counterpart on redis.asyncio - same keys and formats. """
+
+    def __init__(self, url='redis://localhost:6379/0', max_connections=50,
+            key_prefix='cas:', default_timeout=300, client=None, **kwargs):
+
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError('AsyncRedisTicketStore requires the "redis" package')
+            # requests beyond max_connections wait for a connection
+            pool = aioredis.BlockingConnectionPool.from_url(
+                url, max_connections=max_connections, **kwargs)
+            client = aioredis.Redis(connection_pool=pool)
+
+        self.client = client
+        self.key_prefix = key_prefix
+        self.default_timeout = default_timeout
+        self._getdel = True
+        self._claim_script = client.register_script(REDIS_CLAIM_SCRIPT)
+        self._index_script = client.register_script(REDIS_INDEX_ADD_SCRIPT)
+
+    def _expires(self, timeout):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout else '+inf'
+
+    async def get(self, key):
+        return await self.client.get(self.key_prefix + key)
+
+    async def set(self, key, value, timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return await self.client.set(self.key_prefix + key, value, ex=timeout or None)
+
+    async def add(self, key, value, timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return bool(await self.client.set(self.key_prefix + key, value, ex=timeout or None, nx=True))
+
+    async def delete(self, key):
+        return bool(await self.client.delete(self.key_prefix + key))
+
+    async def claim(self, key):
+
+        name = self.key_prefix + key
+        if self._getdel:
+            try:
+                return await self.client.getdel(name)
+            except GETDEL_ERRORS:
+                # server (< 6.2) lacks GETDEL - use the script from now on
+                self._getdel = False
+
+        return await self._claim_script(keys=[name])
+
+    async def index_add(self, index, member, timeout=None):
+
+        await self._index_script(
+            keys=[self.key_prefix + index], args=[time(), self._expires(timeout), member])
+
+    async def set_indexed(self, key, value, timeout, index, index_timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = self._expires(timeout if index_timeout is None else index_timeout)
+
+        # ticket write and index update share one round trip
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key_prefix + key, value, ex=timeout or None)
+        pipe.evalsha(self._index_script.sha, 1, self.key_prefix + index, time(), expires, key)
+        try:
+            await pipe.execute()
+        except aioredis.ResponseError:
+            # script not yet loaded on this server
+            await self._index_script(keys=[self.key_prefix + index], args=[time(), expires, key])
+
+    async def index_purge(self, *indexes, keys=()):
+
+        now = time()
+        pipe = self.client.pipeline(transaction=False)
+        for index in indexes:
+            pipe.zrangebyscore(self.key_prefix + index, now, '+inf')
+        members = [
+            m.decode('utf-8') if isinstance(m, bytes) else m
+            for found in await pipe.execute() for m in found
+        ]
+        names = [self.key_prefix + k for k in (*indexes, *members, *keys)]
+        return await self.client.delete(*names) if names else 0
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def async_ticket_store(config={}, db=None):
+    """ Async store for a sync TicketStore/cachelib cache or the cas_ticket_store config. """
+
+    store_config = config.get('cas_ticket_store')
+
+    if db is None and store_config and store_config.get('store_type') == 'redis' and aioredis:
+        options = dict(store_config)
+        del options['store_type']
+        return AsyncRedisTicketStore(**options)
+
+    if db is None:
+        if not store_config:
+            raise ValueError('A ticket store (db= or cas_ticket_store) is required')
+        db = ticket_store_from_config(store_config)
+
+    return ThreadedTicketStore(as_ticket_store(db))
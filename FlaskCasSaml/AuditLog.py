@@ -0,0 +1,202 @@
+"""
+    Bottle CAS Server - Structured audit events
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+log = logging.getLogger(__name__)
+
+# human readable form of each event - only built when it is written
+MESSAGES = {
+    'tgt_issued': lambda e: f'created {e["tgt"]} for "{e["user"]}"',
+    'service_rejected': lambda e: e['reason'],
+    'ticket_issued': lambda e: f'"{e["user"]}" issued service ticket {e["ticket"]} for "{e["service"]}"',
+    'validate': lambda e: e['reason'],
+    'pgt_callback_failed': lambda e: f'PgtUrl call back failed {e["reason"]} - {e["pgturl"]}',
+    'proxy_issued': lambda e: f'"{e["user"]}" issued proxy ticket {e["ticket"]} for "{e["service"]}"',
+    'proxy_failed': lambda e: f'Error "{e["status"]}" on Proxy request {e["path"]} : "{e["reason"]}"',
+    'logout': lambda e: f'user "{e["user"]}" logged out' + (
+        f' - revoked {e["revoked"]} tickets in {e["duration"]*1000:.1f}ms' if e.get('revoked') is not None else ''),
+}
+
+
+def event_message(kind, fields):
+    """ Log line text for an event. """
+
+    render = MESSAGES.get(kind)
+    return render(fields) if render else f'{kind} {fields}'
+
+
+class LoggerAudit:
+    """ Events as log lines, written on the calling thread (the default).
+
+    The line is only formatted when the logger is enabled for INFO.
+    """
+
+    enabled = False
+
+    def emit(self, kind, **fields):
+
+        logger = current_app.logger if has_app_context() else log
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('CAS: ' + event_message(kind, fields))
+
+    def close(self):
+        pass
+
+
+class AuditLog:
+    """ Events queued for a background writer as JSON lines.
+
+    target - file path ('-' for stdout) or a writable text stream
+    size - queue bound
+    batch - events written per write/flush
+    policy - 'drop' (count and discard when the queue is full) or 'block'
+             (wait up to block_timeout seconds, None - indefinitely, then drop)
+
+    Each line is {"time": <epoch>, "event": <kind>, <fields>..., "message": ...};
+    the request thread only enqueues a tuple.
+    """
+
+    enabled = True
+
+    def __init__(self, target='-', size=10000, batch=256, policy='drop', block_timeout=None):
+
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'Unknown cas_audit_policy "{policy}"')
+
+        self.target = target
+        self.batch = batch
+        self.block = policy == 'block'
+        self.block_timeout = block_timeout
+
+        # metrics
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._queue = queue.Queue(size)
+        self._stream = None
+        self._inode = None
+        self._open()
+
+        self._thread = threading.Thread(target=self._run, name='cas-audit-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, kind, **fields):
+        """ Queue an event - never formats on the calling thread. """
+
+        self.emitted += 1
+        try:
+            if self.block:
+                self._queue.put((time.time(), kind, fields), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((time.time(), kind, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+
+        if not isinstance(self.target, str):
+            self._stream = self.target
+        elif self.target == '-':
+            self._stream = sys.stdout
+        else:
+            self._stream = open(self.target, 'a', encoding='utf-8')
+            self._inode = os.fstat(self._stream.fileno()).st_ino
+
+    def _reopen_if_rotated(self):
+        """ Follow the path to a new file after external log rotation. """
+
+        if self._inode is None:
+            return
+        try:
+            if os.stat(self.target).st_ino == self._inode:
+                return
+        except FileNotFoundError:
+            pass
+        self._stream.close()
+        self._open()
+
+    def _run(self):
+
+        while True:
+            events = [self._queue.get()]
+            while len(events) < self.batch:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in events
+            self._write([e for e in events if e is not None])
+            if stop:
+                return
+
+    def _write(self, events):
+
+        if not events:
+            return
+
+        lines = []
+        for stamp, kind, fields in events:
+            record = {'time': stamp, 'event': kind, **fields}
+            try:
+                record['message'] = event_message(kind, fields)
+            except Exception:
+                pass
+            lines.append(json.dumps(record, default=str))
+
+        try:
+            self._reopen_if_rotated()
+            self._stream.write('\n'.join(lines) + '\n')
+            self._stream.flush()
+            self.written += len(lines)
+        except Exception:
+            self.errors += 1
+            log.exception('CAS: audit log write failed')
+
+    def close(self, timeout=5):
+        """ Write what is queued and stop the writer. """
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+        if self._inode is not None and not self._stream.closed:
+            self._stream.close()
+
+    def stats(self):
+        """ Pipeline counters. """
+
+        return {
+            'emitted': self.emitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'queued': self._queue.qsize(),
+        }
+
+
+def audit_from_config(config):
+    """ AuditLog for cas_audit_log (a path, '-' or a stream), else LoggerAudit. """
+
+    target = config.get('cas_audit_log', None)
+    if target is None:
+        return LoggerAudit()
+    return AuditLog(
+        target,
+        config.get('cas_audit_queue', 10000),
+        config.get('cas_audit_batch', 256),
+        config.get('cas_audit_policy', 'drop'),
+        config.get('cas_audit_block_timeout', None),
+    )
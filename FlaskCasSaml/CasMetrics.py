@@ -0,0 +1,418 @@
+"""
+    Bottle CAS Server - Latency and operation metrics
+"""
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+from .TicketStore import TicketStore
+
+# seconds - sub-millisecond store reads up to slow pgtUrl callbacks
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+HELP = {
+    'cas_request_seconds': 'CAS endpoint latency',
+    'cas_store_seconds': 'Ticket store operation latency',
+    'cas_codec_seconds': 'Ticket serialization latency',
+    'cas_render_seconds': 'Response rendering latency',
+    'cas_pgt_callback_seconds': 'pgtUrl callback latency',
+    'cas_validation_total': 'Ticket validations by status code',
+}
+
+
+class Histogram:
+    """ Fixed-bucket latency histogram. """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    """ Context manager observing its elapsed time. """
+
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class CasMetrics:
+    """ In-process histograms, counters and gauges.
+
+    observe() and inc() record under a metric name and keyword labels;
+    collectors registered with add_collector() are called at scrape time
+    and return {name: value} (names ending _total are counters, the rest
+    gauges). render() produces the Prometheus text format.
+
+    sink - optional callable sink(kind, name, value, labels) also given
+           every observation ('histogram') and increment ('counter'), e.g.
+           to forward to statsd
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, sink=None):
+
+        self.buckets = tuple(buckets)
+        self.sink = sink
+        self._histograms = {}   # (name, labels) -> Histogram
+        self._counters = {}     # (name, labels) -> count
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """ Record a value (seconds) in a histogram. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+        if self.sink is not None:
+            self.sink('histogram', name, value, labels)
+
+    def inc(self, name, amount=1, **labels):
+        """ Add to a counter. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+        if self.sink is not None:
+            self.sink('counter', name, amount, labels)
+
+    def timer(self, name, **labels):
+        """ Context manager recording its duration under name. """
+
+        return _Timer(self, name, labels)
+
+    def add_collector(self, collector):
+        """ Register collector() -> {name: value} for scrape-time values. """
+
+        self._collectors.append(collector)
+
+    def collect(self):
+        """ Scrape-time values from the collectors. """
+
+        values = {}
+        for collector in self._collectors:
+            try:
+                values.update(collector())
+            except Exception:
+                # a failing backend shouldn't take the rest down with it
+                pass
+        return {name: value for name, value in values.items() if value is not None}
+
+    def render(self):
+        """ Prometheus text exposition format. """
+
+        with self._lock:
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), counts, total, count in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip((*self.buckets, '+Inf'), counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{label_text(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{label_text(labels)} {total}')
+            lines.append(f'{name}_count{label_text(labels)} {count}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{label_text(labels)} {value}')
+
+        for name, value in sorted(self.collect().items()):
+            header(name, 'counter' if name.endswith('_total') else 'gauge')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics:
+    """ Disabled metrics - every call is a no-op. """
+
+    enabled = False
+
+    _timer = nullcontext()
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def inc(self, name, amount=1, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._timer
+
+    def add_collector(self, collector):
+        pass
+
+    def render(self):
+        return ''
+
+
+def label_text(labels, le=None):
+    """ {a="1",b="2"} for a sorted label tuple. """
+
+    pairs = [f'{k}="{escape_label(v)}"' for k, v in labels]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsAccess:
+    """ Clients allowed to read /cas/metrics - addresses or CIDR networks.
+
+    With no allow list every client is refused.
+    """
+
+    def __init__(self, allow=None):
+
+        if isinstance(allow, str):
+            allow = [allow]
+        self.networks = tuple(ipaddress.ip_network(entry, strict=False) for entry in allow or ())
+
+    def allowed(self, address):
+        """ May the client at address read the metrics? """
+
+        if not self.networks or not address:
+            return False
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        return any(ip in network for network in self.networks)
+
+
+def metrics_from_config(config):
+    """ CasMetrics for cas_metrics=True (or a CasMetrics instance), else NullMetrics. """
+
+    metrics = config.get('cas_metrics', False)
+    if isinstance(metrics, (CasMetrics, NullMetrics)):
+        return metrics
+    if not metrics:
+        return NullMetrics()
+    return CasMetrics(
+        config.get('cas_metrics_buckets', DEFAULT_BUCKETS),
+        config.get('cas_metrics_sink', None),
+    )
+
+
+#
+# INSTRUMENTED WRAPPERS - installed only when metrics are enabled
+#
+class InstrumentedTicketStore(TicketStore):
+    """ Times each operation of another TicketStore. """
+
+    def __init__(self, store, metrics):
+
+        self.store = store
+        self.metrics = metrics
+        self.default_timeout = store.default_timeout
+
+    @property
+    def capabilities(self):
+        return self.store.capabilities
+
+    def __getattr__(self, name):
+        # store specifics (client, stats...) pass through
+        return getattr(self.store, name)
+
+    def __len__(self):
+        return len(self.store)
+
+    def _timed(self, op, method, *args, **kwargs):
+
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.metrics.observe('cas_store_seconds', time.perf_counter() - started, op=op)
+
+    def get(self, key):
+        return self._timed('get', self.store.get, key)
+
+    def set(self, key, value, timeout=None):
+        return self._timed('set', self.store.set, key, value, timeout)
+
+    def delete(self, key):
+        return self._timed('delete', self.store.delete, key)
+
+    def delete_many(self, *keys):
+        return self._timed('delete_many', self.store.delete_many, *keys)
+
+    def add(self, key, value, timeout=None):
+        return self._timed('add', self.store.add, key, value, timeout)
+
+    def new_key(self, prefix, affinity=None):
+        return self.store.new_key(prefix, affinity)
+
+    def claim(self, key):
+        return self._timed('claim', self.store.claim, key)
+
+    def reap(self, limit=1000):
+        return self._timed('reap', self.store.reap, limit)
+
+    def defer_pruning(self):
+        return self.store.defer_pruning()
+
+    def index_add(self, index, member, timeout=None):
+        return self._timed('index_add', self.store.index_add, index, member, timeout)
+
+    def index_members(self, index):
+        return self._timed('index_members', self.store.index_members, index)
+
+    def index_purge(self, *indexes, keys=()):
+        return self._timed('index_purge', self.store.index_purge, *indexes, keys=keys)
+
+    def set_indexed(self, key, value, timeout, index, index_timeout=None):
+        return self._timed(
+            'set_indexed', self.store.set_indexed, key, value, timeout, index, index_timeout)
+
+    def size(self):
+        return self.store.size()
+
+
+class InstrumentedAsyncTicketStore:
+    """ Times each operation of an async ticket store (as seen by the event loop). """
+
+    def __init__(self, store, metrics):
+
+        self.store = store
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    async def _timed(self, op, method, *args, **kwargs):
+
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            self.metrics.observe('cas_store_seconds', time.perf_counter() - started, op=op)
+
+    async def get(self, key):
+        return await self._timed('get', self.store.get, key)
+
+    async def set(self, key, value, timeout=None):
+        return await self._timed('set', self.store.set, key, value, timeout)
+
+    async def delete(self, key):
+        return await self._timed('delete', self.store.delete, key)
+
+    async def add(self, key, value, timeout=None):
+        return await self._timed('add', self.store.add, key, value, timeout)
+
+    async def claim(self, key):
+        return await self._timed('claim', self.store.claim, key)
+
+    async def index_add(self, index, member, timeout=None):
+        return await self._timed('index_add', self.store.index_add, index, member, timeout)
+
+    async def set_indexed(self, key, value, timeout, index, index_timeout=None):
+        return await self._timed(
+            'set_indexed', self.store.set_indexed, key, value, timeout, index, index_timeout)
+
+    async def index_purge(self, *indexes, keys=()):
+        return await self._timed('index_purge', self.store.index_purge, *indexes, keys=keys)
+
+
+class InstrumentedCodec:
+    """ Times ticket encode/decode. """
+
+    def __init__(self, codec, metrics):
+
+        self.codec = codec
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.codec, name)
+
+    def encode(self, obj):
+        with self.metrics.timer('cas_codec_seconds', op='encode'):
+            return self.codec.encode(obj)
+
+    def decode(self, blob):
+        with self.metrics.timer('cas_codec_seconds', op='decode'):
+            return self.codec.decode(blob)
+
+
+class InstrumentedProxyCallback:
+    """ Times pgtUrl callbacks by outcome. """
+
+    def __init__(self, client, metrics):
+
+        self.client = client
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def callback(self, pgturl, pgt, pgtiou):
+
+        started = time.perf_counter()
+        ok, reason = self.client.callback(pgturl, pgt, pgtiou)
+        self.metrics.observe(
+            'cas_pgt_callback_seconds', time.perf_counter() - started,
+            outcome='ok' if ok else 'failed')
+        return ok, reason
+
+
+def stats_collector(prefix, source, counters=()):
+    """ Collector reporting source.stats() as prefix_<name> (counters as prefix_<name>_total). """
+
+    def collect():
+        return {
+            f'{prefix}_{name}_total' if name in counters else f'{prefix}_{name}': value
+            for name, value in source.stats().items()
+        }
+    return collect
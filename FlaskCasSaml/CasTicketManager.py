@@ -1,13 +1,35 @@
 """
     Bottle CAS Server - CAS Ticket Management
 """
+import hashlib
 import json
+import time
 from secrets import token_urlsafe
 
-from flask import request, current_app, session
-import requests as req
+from flask import request, session, g
 
 from .URNmanager import URNmanager
+from .TicketStore import INDEX, LOCAL, claim, as_ticket_store
+from .TicketCodec import TicketCodec
+from .ProxyCallback import ProxyCallbackClient
+from .TicketReaper import TicketReaper
+from .TicketCache import GrantingTicketCache, cache_client
+from .AuditLog import audit_from_config
+from .TicketSigner import TicketSigner
+from .CasMetrics import (
+    MetricsAccess,
+    metrics_from_config,
+    stats_collector,
+    InstrumentedTicketStore,
+    InstrumentedCodec,
+    InstrumentedProxyCallback,
+)
+
+def attributes_digest(attrs):
+    """ Content digest of an attribute set. """
+
+    return hashlib.sha256(json.dumps(attrs, sort_keys=True).encode('utf-8')).hexdigest()
+
 
 class CasTicketManager:
     """ Cas Ticket Management """
@@ -18,24 +40,37 @@ class CasTicketManager:
 
     def __init__(self, auth, config={}, db=None):
 
-        self.db = db
+        # cachelib caches are adapted to the TicketStore interface
+        self.db = as_ticket_store(db)
+
+        # Latency and operation metrics (def: disabled - no instrumentation)
+        self.metrics = metrics_from_config(config)
+        if self.metrics.enabled and self.db is not None:
+            self.db = InstrumentedTicketStore(self.db, self.metrics)
 
-        # Tie Auth to tgt
-        auth.add_login_hook(self.issue_tgt_ticket_hook)
+        # Client addresses/networks allowed to read /cas/metrics (def: None - no client)
+        self.metrics_access = MetricsAccess(config.get('cas_metrics_allow', None))
+
+        # Tie Auth to tgt (back-channel only servers have no auth)
+        if auth is not None:
+            auth.add_login_hook(self.issue_tgt_ticket_hook)
 
         # Ticket lifetimes
         self.cas_service_ticket_life = config.get('cas_st_life',5*60)
         self.cas_tgt_life = config.get('cas_tgt_life',8*60*60)
         self.cas_pgt_life = config.get('cas_pgt_life',4*60*60)
         
+        # Poll interval (seconds) for service/proxy list changes (def: no reload)
+        reload_interval = config.get('cas_services_reload', None)
+
         # List of permitted services
-        self.service_list = URNmanager(config.get('cas_services_filename', None))
+        self.service_list = URNmanager(config.get('cas_services_filename', None), reload_interval)
 
         # List of permitted proxy services
-        self.proxy_list = URNmanager(config.get('cas_proxys_filename', None))
+        self.proxy_list = URNmanager(config.get('cas_proxys_filename', None), reload_interval)
 
-        # verify SSL when issuing PgtIOU
-        self.sslverify = config.get('verify_ssl', True)
+        # pooled client for pgtUrl callbacks (reads verify_ssl itself)
+        self.pgt_client = ProxyCallbackClient(config)
 
         # Enable/disable proxy support (def: enabled)
         self.cas_proxy_support = config.get('cas_proxy_support', True)
@@ -43,21 +78,105 @@ class CasTicketManager:
         # Enable/disable samlValidate support (def: disabled)
         self.cas_samlValidate_support = config.get('cas_samlValidate', False)
 
+        # Ticket blob serialization (def: legacy JSON, uncompressed)
+        self.codec = TicketCodec(
+            config.get('cas_ticket_codec', 'json'),
+            config.get('cas_ticket_compress_min', None)
+        )
+
+        # Child tickets reference a shared attribute record (def: disabled)
+        self.cas_share_attributes = config.get('cas_share_attributes', False)
+
+        # Signed ST/PT's carrying their own content - no store write to issue (def: disabled)
+        self.signer = TicketSigner(
+            config.get('cas_ticket_secret', None)
+        ) if config.get('cas_stateless_tickets', False) else None
+
+        # Index ST/PT/PGT's under their TGT so logout revokes them (def: stores
+        # with native indexes - elsewhere each ticket would cost an index read-modify-write;
+        # no db - the async redis store)
+        logout_revoke = config.get('cas_logout_revoke', None)
+        self.cas_logout_revoke = (self.db is None or self.db.supports(INDEX)) \
+            if logout_revoke is None else logout_revoke
+
+        # Process-local cache of TGT/PGT's for N seconds (0 - disabled; def: 30 only where
+        # logout reaches every copy - a pubsub channel or an in-process store)
+        cache_pubsub = config.get('cas_tgt_cache_pubsub', None)
+        cache_ttl = config.get('cas_tgt_cache_ttl', None)
+        if cache_ttl is None:
+            cache_ttl = 30 if cache_pubsub or (self.db is not None and self.db.supports(LOCAL)) else 0
+        cache_size = config.get('cas_tgt_cache_size', 1024)
+        self.tgt_cache = GrantingTicketCache(
+            cache_size,
+            cache_ttl,
+            cache_client(cache_pubsub, self.db),
+        ) if cache_ttl and cache_size else None
+
+        # Background sweep of expired tickets every N seconds (def: disabled)
+        reaper_interval = config.get('cas_reaper_interval', None)
+        self.reaper = None
+        if reaper_interval and self.db is not None:
+            if not config.get('cas_reaper_inline_prune', False):
+                self.db.defer_pruning()
+            self.reaper = TicketReaper(
+                self.db, reaper_interval, config.get('cas_reaper_batch', 1000)
+            ).start()
+
+        # Structured events to a JSON-lines writer thread (def: None - log lines)
+        self.audit = audit_from_config(config)
+
+        if self.metrics.enabled:
+            self.instrument()
+
+    def instrument(self):
+        """ Time serialization and pgtUrl callbacks; report store, cache and reaper state. """
+
+        self.codec = InstrumentedCodec(self.codec, self.metrics)
+        self.pgt_client = InstrumentedProxyCallback(self.pgt_client, self.metrics)
+
+        if self.db is not None:
+            self.metrics.add_collector(lambda: {'cas_ticket_store_entries': self.db.size()})
+            if hasattr(self.db.store, 'stats'):
+                self.metrics.add_collector(stats_collector(
+                    'cas_ticket_store', self.db, counters=('hits', 'misses', 'expired', 'evicted', 'handoff_reads')))
+        for prefix, urn_list in (('cas_service_list', self.service_list), ('cas_proxy_list', self.proxy_list)):
+            if urn_list.filepath:
+                self.metrics.add_collector(stats_collector(
+                    prefix, urn_list, counters=('reloads', 'reload_errors')))
+        if self.tgt_cache:
+            self.metrics.add_collector(stats_collector(
+                'cas_tgt_cache', self.tgt_cache, counters=('hits', 'misses', 'invalidations')))
+        if self.reaper:
+            self.metrics.add_collector(stats_collector(
+                'cas_reaper', self.reaper, counters=('cycles', 'removed', 'errors')))
+        if self.audit.enabled:
+            self.metrics.add_collector(stats_collector(
+                'cas_audit', self.audit, counters=('emitted', 'written', 'dropped', 'errors')))
+
     def issue_tgt_ticket_hook(self, username, attrs):
         """ Hook establishing Ticket Granting Ticket for authed user. """
 
-        # Does a TGT already exist for this user?
-        tgt = session.get(self.CAS_TGT, 'TGT-' + token_urlsafe())
+        # Does a TGT already exist for this user? (new ones are placed with the user's PGT index)
+        tgt = session.get(self.CAS_TGT) or self.new_ticket_id('TGT-', 'sessPGT:' + username)
+
+        granting_ticket = {
+            'tgt' : tgt,
+            'username' : username,
+            'details' : attrs,
+            'details_digest' : attributes_digest(attrs),
+            'is_proxy': False,
+        }
+        if self.cas_share_attributes:
+            # ST/PT/PGT's will reference this record rather than copy attrs
+            granting_ticket['details_ref'] = self.share_attributes(
+                attrs, granting_ticket['details_digest'])
 
-        self.db.set(tgt, 
-            json.dumps({
-                    'username' : username,
-                    'details' : attrs,
-                    'is_proxy': False,
-                }),
-            self.cas_tgt_life)
+        self.db.set(tgt, self.codec.encode(granting_ticket), self.cas_tgt_life)
+        if self.tgt_cache:
+            # reauthentication replaces the ticket - drop stale copies
+            self.tgt_cache.invalidate(tgt)
 
-        current_app.logger.info(f'CAS: created {tgt} for "{username}"')
+        self.audit.emit('tgt_issued', user=username, tgt=tgt)
         
         # assocaite this session with the tgt
         session[self.CAS_TGT] = tgt
@@ -75,42 +194,103 @@ class CasTicketManager:
             # no pgturl -> no PGT is created
             return None
         
-        proxy_ticket = 'PGT-' + token_urlsafe()
-        pgtiou = 'PGTIOU-' + token_urlsafe()
+        proxy_ticket, pgtiou = self.new_pgt_ids(st_ticket.get('tgt'))
 
-        resp = req.get(pgturl, params={'pgtId':proxy_ticket, 'pgtIou': pgtiou}, verify=self.sslverify)
-        if resp.status_code == req.codes.ok:
+        ok, reason = self.pgt_client.callback(pgturl, proxy_ticket, pgtiou)
+        if ok:
             # Proxy server successfully received pgtiou=>pgt mapping
+            pgt_ticket = self.build_pgt_ticket(pgturl, st_ticket)
 
-            # add list of proxies to pgt
-            if 'proxies' not in st_ticket:
-                prox_list =[]
-            else:
-                prox_list = st_ticket['proxies'].copy()
-
-            prox_list.insert(0, pgturl)
+            if 'details_ref' in pgt_ticket:
+                # refresh the shared record's lifetime to cover this pgt
+                self.share_attributes(st_ticket['details'], ref=pgt_ticket['details_ref'])
 
             # save the pgt
-            self.db.set(proxy_ticket,
-                json.dumps({
-                    'username' : st_ticket['username'],
-                    'details' : st_ticket['details'],
-                    'is_proxy' : True,
-                    'proxies' : prox_list,
-                }),
-                self.cas_pgt_life
-            )
+            self.save_ticket(proxy_ticket, pgt_ticket, self.cas_pgt_life)
 
             # keep track of these for removal when user logs out
             self.track_pgt(proxy_ticket, st_ticket['username'])
 
             return pgtiou
         else:
-            current_app.logger.info(f'CAS: PgtUrl call back failed {resp.status_code} - {pgturl}')
-        
+            self.audit.emit('pgt_callback_failed', user=st_ticket['username'], pgturl=pgturl, reason=reason)
+
         return None
+
+
+    def new_ticket_id(self, prefix, affinity=None):
+        """ New ticket id - the store may place it beside affinity (e.g. its TGT). """
+
+        if self.db is None:
+            return prefix + token_urlsafe()
+        return self.db.new_key(prefix, affinity)
+
+
+    def new_pgt_ids(self, root=None):
+        """ New (PGT, PGTIOU) pair - the PGT placed with its root TGT. """
+
+        return self.new_ticket_id('PGT-', root), 'PGTIOU-' + token_urlsafe()
+
+
+    def build_pgt_ticket(self, pgturl, st_ticket):
+        """ Proxy Granting Ticket content for a validated service/proxy ticket. """
+
+        # add list of proxies to pgt
+        if 'proxies' not in st_ticket:
+            prox_list =[]
+        else:
+            prox_list = st_ticket['proxies'].copy()
+
+        prox_list.insert(0, pgturl)
+
+        pgt_ticket = {
+            'tgt' : st_ticket.get('tgt'),
+            'username' : st_ticket['username'],
+            'is_proxy' : True,
+            'proxies' : prox_list,
+        }
+        if 'details_digest' in st_ticket:
+            pgt_ticket['details_digest'] = st_ticket['details_digest']
+        if 'details_ref' in st_ticket:
+            pgt_ticket['details_ref'] = self.attributes_ref(
+                st_ticket['details'], st_ticket.get('details_digest'))
+        else:
+            pgt_ticket['details'] = st_ticket['details']
+
+        return pgt_ticket
        
 
+    def attributes_ref(self, attrs, digest=None):
+        """ Reference of the shared attribute record for attrs. """
+
+        # content addressed - identical attribute sets share one record
+        return 'CASATTR-' + (digest or attributes_digest(attrs))
+
+
+    def share_attributes(self, attrs, digest=None, ref=None):
+        """ Save a shared attribute record - returns its reference. """
+
+        ref = ref or self.attributes_ref(attrs, digest)
+        blob = self.codec.encode(attrs)
+
+        # must outlive any granting ticket that refers to it
+        self.db.set(ref, blob, max(self.cas_tgt_life, self.cas_pgt_life))
+
+        return ref
+
+
+    def resolve_attributes(self, ticket):
+        """ Fill in details for a ticket holding an attribute reference. """
+
+        if 'details' not in ticket and 'details_ref' in ticket:
+            attrs = self.db.get(ticket['details_ref'])
+            if attrs is None:
+                return False
+            ticket['details'] = self.codec.decode(attrs)
+
+        return True
+
+
     def lookup_proxy_granting_ticket(self, pgt):
         """ Retrieve PGT. """
 
@@ -118,31 +298,66 @@ class CasTicketManager:
 
 
     def lookup_granting_ticket(self, tgt):
-        """ Retrieve a proxy granting ticket or None. """
-        
+        """ Retrieve a granting ticket (TGT or PGT) or None - don't modify it. """
+
+        if not tgt:
+            return None
+
+        if self.tgt_cache:
+            ticket = self.tgt_cache.get(tgt)
+            if ticket is not None:
+                return ticket
+
         ticket_data = self.db.get(tgt)
-        return json.loads(ticket_data) if ticket_data else None
+        if not ticket_data:
+            return None
+
+        ticket = self.codec.decode(ticket_data)
+        if self.tgt_cache:
+            self.tgt_cache.put(tgt, ticket)
+        return ticket
 
 
     def track_pgt(self, pgt, username):
         """ Track PGT for a given user. """
         
-        # Retrieve list of pgt's associated with this user
-        key = 'sessPGT:' + username
-        pgt_track = self.db.get(key)
+        # per-user index of pgt's - entries expire with the pgt
+        self.db.index_add('sessPGT:' + username, pgt, self.cas_pgt_life)
+
+
+    def save_ticket(self, key, ticket, life):
+        """ Save a ticket descended from a TGT - indexed under the TGT for logout. """
+
+        blob = self.codec.encode(ticket)
+        root = ticket.get('tgt')
 
-        if pgt_track:
-            # Append to the existing list
-            pgt_list = json.loads(pgt_track)
+        if self.cas_logout_revoke and root:
+            self.db.set_indexed(key, blob, life, 'tgtIdx:' + root)
         else:
-            # new list
-            pgt_list = []
-        
-        # append this pgt and save
-        pgt_list.append(pgt)
-        self.db.set(key, json.dumps(pgt_list))
+            self.db.set(key, blob, life)
+
+
+    def revoke_granting_ticket(self, tgt, username=None):
+        """ Revoke a TGT and every ticket issued from it - returns (count, seconds). """
 
-        return
+        started = time.perf_counter()
+
+        if not username:
+            # the user's PGT's go too
+            username = (self.lookup_granting_ticket(tgt) or {}).get('username')
+
+        indexes = ['tgtIdx:' + tgt] if self.cas_logout_revoke else []
+        if username:
+            indexes.append('sessPGT:' + username)
+
+        # one batch for everything
+        removed = self.db.index_purge(*indexes, keys=(tgt,))
+
+        if self.tgt_cache:
+            # the user's cached TGT and PGT's, here and in other processes
+            self.tgt_cache.invalidate(tgt, username)
+
+        return removed, time.perf_counter() - started
 
 
     def destroy_pgts(self, username):
@@ -151,72 +366,169 @@ class CasTicketManager:
         if not username:
             return
 
-        key = 'sessPGT:' + username
-        pgt_list = []
-        
-        # load list of pgts for this user
-        pgt_track = self.db.get(key)
-        pgt_list = json.loads(pgt_track) if pgt_track else []
+        # remove PGT's (and the index itself) because user is logging out
+        self.db.index_purge('sessPGT:' + username)
 
-        for pgt in pgt_list:
-            # remove PGT's because user is logging out
-            self.db.delete(pgt)
-        
-        # remove the list itself
-        self.db.delete(key)
+        if self.tgt_cache:
+            self.tgt_cache.invalidate(username=username)
 
 
 #
 # CAS SERVICE/PROXY TICKET MANAGEMENT
 #
-    def issue_ticket(self, granting_ticket, service, proxy=False, renewed=False):
+    def issue_ticket(self, granting_ticket, service, proxy=False, renewed=False, granted_by=None):
         """ Issue a service or proxy ticket. """
 
+        service_ticket = self.signed_ticket(granting_ticket, service, proxy, renewed, granted_by)
+        if service_ticket:
+            return service_ticket
+
+        service_ticket, new_ticket = self.build_ticket(granting_ticket, service, proxy, renewed)
+        self.save_ticket(service_ticket, new_ticket, self.cas_service_ticket_life)
+
+        return service_ticket
+
+
+    def signed_ticket(self, granting_ticket, service, proxy=False, renewed=False, granted_by=None):
+        """ Signed ticket (nothing stored) or None if disabled or it won't fit.
+
+        granted_by - id of the granting ticket (def: the TGT, for service tickets)
+        """
+
+        if self.signer is None:
+            return None
+
+        return self.signer.issue(
+            'PT-' if proxy else 'ST-',
+            granted_by or granting_ticket.get('tgt'),
+            service,
+            self.cas_service_ticket_life,
+            renewed and not proxy,
+        )
+
+
+    def build_ticket(self, granting_ticket, service, proxy=False, renewed=False):
+        """ New service or proxy ticket - returns (ticket id, content). """
+
         prefix = 'PT-' if proxy else 'ST-'
 
+        return (
+            self.new_ticket_id(prefix, granting_ticket.get('tgt')),
+            self.ticket_content(granting_ticket, service, proxy, renewed),
+        )
+
+
+    def ticket_content(self, granting_ticket, service, proxy=False, renewed=False):
+        """ Service or proxy ticket content derived from its granting ticket. """
+
         new_ticket = {
+            'tgt' : granting_ticket.get('tgt'),
             'service' : service,
             'username' : granting_ticket['username'],
-            'details' : granting_ticket['details'],
             'is_proxy_ticket': proxy,
             'creds_presented': renewed and not proxy,
         }
+        if 'details_digest' in granting_ticket:
+            # keys cached serializations of the attributes
+            new_ticket['details_digest'] = granting_ticket['details_digest']
+        if 'details_ref' in granting_ticket:
+            # attributes are resolved when the ticket is claimed
+            new_ticket['details_ref'] = granting_ticket['details_ref']
+        else:
+            new_ticket['details'] = granting_ticket['details']
         if proxy:
             # pt's include proxy validation chain
             new_ticket['proxies'] = granting_ticket['proxies']
 
-        service_ticket = prefix + token_urlsafe()
-        self.db.set(service_ticket,
-                json.dumps(new_ticket),
-                self.cas_service_ticket_life,
-            )
+        return new_ticket
 
-        return service_ticket
+
+    def check_proxy_request(self, pgt, target_service):
+        """ /cas/proxy request checks before the PGT lookup - returns (error, message). """
+
+        if not self.cas_proxy_support:
+            return 'INVALID_REQUEST', 'Proxy support disabled on this server.'
+
+        if not pgt or not target_service:
+            # pgt and target_service are required parameters for /cas/proxy
+            return 'INVALID_REQUEST', 'Both a pgt and targetService is required.'
+
+        if not self.service_list.valid(target_service):
+            # Service is not permitted
+            return 'INVALID_SERVICE', f'Invalid proxy service request {target_service}'
+
+        if not pgt.startswith('PGT-'):
+            return 'INVALID_TICKET', f'{pgt} is not a Proxy Grant Ticket'
+
+        return None, None
 
 
     def claim_ticket(self, service_ticket):
         """ Claim a service or proxy ticket. """
 
-        # Redis stored tickets 
-        ticket = self.db.get(service_ticket) if service_ticket else None
+        if self.signer and self.signer.is_signed(service_ticket):
+            return self.claim_signed_ticket(service_ticket)
+
+        # ticket claims are one-shot - fetch and remove in one operation
+        ticket = claim(self.db, service_ticket)
 
         if ticket:
-            # ticket claims are one-shot so remove this
-            self.db.delete(service_ticket)
+            ticket = self.codec.decode(ticket)
 
-            ticket = json.loads(ticket)
+            if not self.resolve_attributes(ticket):
+                ticket = self.attributes_expired(service_ticket)
         else:
-            ticket = {
-                'error' : f'Can not find ticket "{service_ticket}"',
-                'status' : 'INVALID_TICKET',
-            }
+            ticket = self.ticket_not_found(service_ticket)
         
         return ticket
 
 
+    def claim_signed_ticket(self, service_ticket):
+        """ Claim a signed service or proxy ticket. """
+
+        opened = self.signer.open(service_ticket)
+        if opened is None:
+            return self.ticket_not_found(service_ticket)
+
+        granting_ticket = self.lookup_granting_ticket(opened['granted_by'])
+
+        # one shot - the first claim records the ticket as spent
+        if granting_ticket is None or not self.db.add(opened['spent_key'], '1', opened['spent_life']):
+            return self.ticket_not_found(service_ticket)
+
+        ticket = self.ticket_content(granting_ticket, opened['service'], opened['proxy'], opened['renewed'])
+
+        if not self.resolve_attributes(ticket):
+            ticket = self.attributes_expired(service_ticket)
+
+        return ticket
+
+
+    @staticmethod
+    def ticket_not_found(service_ticket):
+        """ Claim result for a missing ticket. """
+
+        return {
+            'error' : f'Can not find ticket "{service_ticket}"',
+            'status' : 'INVALID_TICKET',
+        }
+
+
+    @staticmethod
+    def attributes_expired(service_ticket):
+        """ Claim result for a ticket whose shared attributes are gone. """
+
+        return {
+            'error' : f'Attributes for ticket "{service_ticket}" have expired',
+            'status' : 'INVALID_TICKET',
+        }
+
+
     def validate_ticket(self, ticket=None, service=None, proxysok=False):
         """ Validate a service or proxy ticket. """
 
+        started = time.perf_counter()
+
         if ticket is None:
             ticket = request.args.get('ticket')
 
@@ -225,14 +537,38 @@ class CasTicketManager:
         
         pgturl = request.args.get('pgtUrl')
         renew = request.args.get('renew')
-        
-        status = None
-        reason = None
-        pgtiou = None
 
         # always claim the ticket - one shot at validation
         service_ticket = self.claim_ticket(ticket)
 
+        status, reason = self.check_ticket(
+            ticket, service, service_ticket, pgturl, renew, proxysok)
+
+        pgtiou = None
+        if status == 'OK':
+            pgtiou = self.issue_pgt_ticket(pgturl, service_ticket)
+            status, reason = self.check_pgtiou(
+                status, reason, ticket, pgturl, pgtiou, service_ticket)
+
+        self.metrics.inc('cas_validation_total', status=status)
+        g.cas_outcome = status
+        self.audit.emit(
+            'validate',
+            status=status,
+            user=service_ticket.get('username'),
+            service=service,
+            ticket=ticket,
+            pgt=pgtiou is not None,
+            reason=reason,
+            duration=time.perf_counter() - started,
+        )
+
+        return (status, reason, service_ticket)
+
+
+    def check_ticket(self, ticket, service, service_ticket, pgturl=None, renew=None, proxysok=False):
+        """ Validation rules for a claimed ticket - returns (status, reason). """
+
         if not service or not ticket:
             reason = f'Service and ticket both requred for ticket "{ticket}"'
             status = 'INVALID_REQUEST'
@@ -273,17 +609,20 @@ class CasTicketManager:
             # All criteria met - Good to go
             reason = f'Successful validation of {ticket} by "{service_ticket["username"]}" for "{service}"'
             status = 'OK'
-            
-            pgtiou = self.issue_pgt_ticket(pgturl, service_ticket)
 
-            if pgturl and pgtiou is None:
-                status = 'INVALID_PROXY_CALLBACK'
-                reason = f'Proxy callback failed for "{pgturl}" with ticket {ticket}'
+        return status, reason
 
-            elif pgtiou:
-                service_ticket['pgtiou'] = pgtiou
 
-        current_app.logger.info(f'CAS: {reason}')
+    @staticmethod
+    def check_pgtiou(status, reason, ticket, pgturl, pgtiou, service_ticket):
+        """ Outcome of the pgtUrl callback for a valid ticket - returns (status, reason). """
 
-        return (status, reason, service_ticket)
+        if pgturl and pgtiou is None:
+            status = 'INVALID_PROXY_CALLBACK'
+            reason = f'Proxy callback failed for "{pgturl}" with ticket {ticket}'
+
+        elif pgtiou:
+            service_ticket['pgtiou'] = pgtiou
+
+        return status, reason
     
@@ -0,0 +1,191 @@
+"""
+    Bottle CAS Server - pgtUrl callbacks
+"""
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests as req
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class CircuitBreaker:
+    """ Per-host circuit breaker for pgtUrl callbacks.
+
+    After `failures` consecutive failures a host's circuit opens and calls
+    fail immediately for `reset` seconds; then a single trial call is let
+    through (half open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failures=5, reset=30):
+
+        self.failures = failures
+        self.reset = reset
+        self._hosts = {}        # host -> [consecutive failures, opened at]
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        """ May a call be made to host now? """
+
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return True
+            if time.monotonic() - state[1] >= self.reset:
+                # half open - let this call through, hold the rest
+                state[1] = time.monotonic()
+                return True
+            return False
+
+    def record(self, host, ok):
+        """ Record the outcome of a call to host. """
+
+        with self._lock:
+            if ok:
+                self._hosts.pop(host, None)
+                return
+            state = self._hosts.setdefault(host, [0, None])
+            state[0] += 1
+            if state[0] >= self.failures:
+                state[1] = time.monotonic()
+
+    def open_hosts(self):
+        """ Hosts whose circuit is currently open. """
+
+        with self._lock:
+            return [host for host, (_, opened) in self._hosts.items() if opened is not None]
+
+
+def breaker_from_config(config):
+    """ Fail fast on hosts that keep failing (def: disabled) """
+
+    failures = config.get('cas_pgt_breaker_failures', None)
+    return CircuitBreaker(
+        failures, config.get('cas_pgt_breaker_reset', 30)
+    ) if failures else None
+
+
+class ProxyCallbackClient:
+    """ Pooled, time-bounded HTTP client for pgtUrl callbacks. """
+
+    def __init__(self, config={}):
+
+        # verify SSL when issuing PgtIOU
+        self.sslverify = config.get('verify_ssl', True)
+
+        # (connect, read) timeouts in seconds
+        self.timeout = (
+            config.get('cas_pgt_connect_timeout', 3),
+            config.get('cas_pgt_read_timeout', 5),
+        )
+
+        # keep-alive connections (and their TLS sessions) are reused per host;
+        # a burst to one host waits for one of its pool_size connections
+        self.session = req.Session()
+        adapter = HTTPAdapter(
+            pool_connections=config.get('cas_pgt_pool_hosts', 10),
+            pool_maxsize=config.get('cas_pgt_pool_size', 10),
+            pool_block=True,
+            max_retries=0
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.breaker = breaker_from_config(config)
+
+    def callback(self, pgturl, pgt, pgtiou):
+        """ Deliver the pgtIou => pgtId mapping - returns (ok, reason). """
+
+        host = urlsplit(pgturl).netloc.lower()
+
+        if self.breaker and not self.breaker.allow(host):
+            return False, f'circuit open for {host}'
+
+        try:
+            resp = self.session.get(
+                pgturl,
+                params={'pgtId': pgt, 'pgtIou': pgtiou},
+                verify=self.sslverify,
+                timeout=self.timeout
+            )
+            ok = resp.status_code == req.codes.ok
+            reason = resp.status_code
+            resp.close()
+
+        except req.RequestException as e:
+            ok = False
+            reason = type(e).__name__
+
+        if self.breaker:
+            self.breaker.record(host, ok)
+
+        return ok, reason
+
+
+class AsyncProxyCallbackClient:
+    """ pgtUrl callbacks for asyncio servers.
+
+    Uses a pooled httpx.AsyncClient when httpx is installed; otherwise the
+    blocking ProxyCallbackClient runs in the default executor.
+    """
+
+    def __init__(self, config={}):
+
+        self.sslverify = config.get('verify_ssl', True)
+        self.breaker = breaker_from_config(config)
+        self.client = None
+        self.sync_client = None
+
+        if httpx is not None:
+            self.client = httpx.AsyncClient(
+                verify=self.sslverify,
+                timeout=httpx.Timeout(
+                    config.get('cas_pgt_read_timeout', 5),
+                    connect=config.get('cas_pgt_connect_timeout', 3)
+                ),
+                limits=httpx.Limits(
+                    max_connections=config.get('cas_pgt_pool_hosts', 10) * config.get('cas_pgt_pool_size', 10),
+                    max_keepalive_connections=config.get('cas_pgt_pool_size', 10)
+                ),
+            )
+        else:
+            self.sync_client = ProxyCallbackClient(config)
+            self.sync_client.breaker = self.breaker
+
+    async def callback(self, pgturl, pgt, pgtiou):
+        """ Deliver the pgtIou => pgtId mapping - returns (ok, reason). """
+
+        if self.client is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.sync_client.callback, pgturl, pgt, pgtiou)
+
+        host = urlsplit(pgturl).netloc.lower()
+
+        if self.breaker and not self.breaker.allow(host):
+            return False, f'circuit open for {host}'
+
+        try:
+            resp = await self.client.get(pgturl, params={'pgtId': pgt, 'pgtIou': pgtiou})
+            ok = resp.status_code == 200
+            reason = resp.status_code
+
+        except httpx.HTTPError as e:
+            ok = False
+            reason = type(e).__name__
+
+        if self.breaker:
+            self.breaker.record(host, ok)
+
+        return ok, reason
+
+    async def aclose(self):
+        """ Close pooled connections. """
+
+        if self.client is not None:
+            await self.client.aclose()
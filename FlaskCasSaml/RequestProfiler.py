@@ -0,0 +1,137 @@
+"""
+    Bottle CAS Server - Sampling request profiler
+"""
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RequestProfiler:
+    """ cProfile a random sample of requests, aggregated per (endpoint, outcome).
+
+    Every `interval` seconds the aggregated profiles are written to
+    `directory` as pstats dumps (snakeviz, gprof2dot, flameprof...) named
+
+        cas-profile-<endpoint>-<outcome>-<YYYYmmddTHHMMSS>-<pid>.prof
+
+    and only the newest `keep` dumps are kept. One request is profiled at a
+    time; sampled requests that overlap another are skipped.
+    """
+
+    PREFIX = 'cas-profile-'
+
+    def __init__(self, directory='./cas_profiles', rate=0.01, interval=300, keep=48):
+
+        self.directory = directory
+        self.rate = rate
+        self.interval = interval
+        self.keep = keep
+
+        # metrics
+        self.sampled = 0
+        self.skipped = 0
+        self.dumps = 0
+
+        self._busy = threading.Lock()       # held while a request is profiled
+        self._lock = threading.Lock()       # guards _stats
+        self._stats = {}                    # (endpoint, outcome) -> pstats.Stats
+        self._next_flush = time.monotonic() + interval
+
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def start(self):
+        """ A running profile if this request is sampled, else None. """
+
+        if random.random() >= self.rate:
+            return None
+
+        if not self._busy.acquire(blocking=False):
+            self.skipped += 1
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler (or debugger/coverage) holds the hook
+            self._busy.release()
+            self.skipped += 1
+            return None
+        return profile
+
+    def finish(self, profile, endpoint, outcome):
+        """ Stop profile and add it to the aggregate for (endpoint, outcome). """
+
+        try:
+            profile.disable()
+        finally:
+            self._busy.release()
+        self.sampled += 1
+
+        key = (tag(endpoint), tag(outcome))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                self._stats[key] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+        if time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def flush(self):
+        """ Write and reset the aggregated profiles, then rotate old dumps. """
+
+        with self._lock:
+            collected, self._stats = self._stats, {}
+            self._next_flush = time.monotonic() + self.interval
+
+        if not collected:
+            return
+
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        for (endpoint, outcome), stats in collected.items():
+            path = os.path.join(
+                self.directory, f'{self.PREFIX}{endpoint}-{outcome}-{stamp}-{os.getpid()}.prof')
+            try:
+                stats.dump_stats(path)
+                self.dumps += 1
+            except OSError:
+                log.exception(f'CAS: failed writing profile {path}')
+
+        self.rotate()
+
+    def rotate(self):
+        """ Remove all but the newest `keep` dumps. """
+
+        try:
+            dumps = [
+                entry for entry in os.scandir(self.directory)
+                if entry.name.startswith(self.PREFIX) and entry.name.endswith('.prof')
+            ]
+            dumps.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in dumps[self.keep:]:
+                os.remove(entry.path)
+        except OSError:
+            # another worker sharing the directory got there first
+            pass
+
+    def stats(self):
+        """ Profiler counters. """
+
+        return {'sampled': self.sampled, 'skipped': self.skipped, 'dumps': self.dumps}
+
+
+def tag(text):
+    """ File name safe form of an endpoint or outcome. """
+
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(text)).strip('_') or 'none'
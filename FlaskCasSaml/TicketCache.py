@@ -0,0 +1,151 @@
+"""
+    Bottle CAS Server - Process-local granting ticket cache
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+
+class GrantingTicketCache:
+    """ Short-TTL read-through cache of decoded TGT/PGTs.
+
+    Granting tickets don't change once issued, so /cas/login and /cas/proxy
+    can be answered from here rather than the ticket store. Entries are
+    dropped on logout and TGT reissue; with a redis client the same
+    invalidations are published to every other process sharing the channel.
+    Without one, another process may still honour a revoked ticket for up
+    to `ttl` seconds.
+
+    Cached tickets are shared - callers must not modify them.
+    """
+
+    CHANNEL = 'cas:ticket-invalidate'
+
+    def __init__(self, size=1024, ttl=30, client=None, channel=CHANNEL):
+
+        self.size = size
+        self.ttl = ttl
+        self.channel = channel
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()   # key -> (expires, username, ticket)
+        self._users = {}                # username -> {keys}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        if client is not None:
+            self._thread = threading.Thread(
+                target=self._listen, name='cas-ticket-invalidate', daemon=True)
+            self._thread.start()
+
+    def get(self, key):
+        """ Cached ticket for key or None. """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, ticket):
+        """ Cache ticket under key. """
+
+        username = ticket.get('username')
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, username, ticket)
+            self._users.setdefault(username, set()).add(key)
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        """ Remove key - caller holds the lock. """
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._users.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._users[entry[1]]
+
+    def _discard(self, key=None, username=None):
+
+        with self._lock:
+            if key:
+                self._drop(key)
+            for k in list(self._users.get(username, ())) if username else ():
+                self._drop(k)
+            self.invalidations += 1
+
+    def invalidate(self, key=None, username=None):
+        """ Drop key and (with username) every ticket cached for the user, in all processes. """
+
+        self._discard(key, username)
+
+        if self.client is not None:
+            try:
+                self.client.publish(self.channel, f'{key or ""}\n{username or ""}')
+            except Exception:
+                log.exception('CAS: ticket cache invalidation publish failed')
+
+    def _listen(self):
+        """ Apply invalidations published by other processes. """
+
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    data = message.get('data')
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    key, _, username = str(data).partition('\n')
+                    self._discard(key or None, username or None)
+
+            except Exception:
+                log.exception('CAS: ticket cache invalidation listener failed')
+
+            # missed messages - forget everything, then resubscribe
+            with self._lock:
+                self._entries.clear()
+                self._users.clear()
+            time.sleep(1)
+
+    def stats(self):
+        """ Cache counters. """
+
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+def cache_client(pubsub, db):
+    """ Redis client for invalidations - a url, or True for the ticket store's client. """
+
+    if not pubsub:
+        return None
+    if pubsub is True:
+        client = getattr(db, 'client', None)
+        if client is None:
+            raise ValueError('cas_tgt_cache_pubsub=True requires a redis ticket store')
+        return client
+    if redis is None:
+        raise RuntimeError('cas_tgt_cache_pubsub requires the "redis" package')
+    return redis.Redis.from_url(pubsub)
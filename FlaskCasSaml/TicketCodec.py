@@ -0,0 +1,97 @@
+"""
+    Bottle CAS Server - Ticket serialization
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Tagged blobs: MARK + format tag + payload. Untagged blobs are legacy JSON.
+MARK = b'\x01'
+TAG_JSON = b'J'         # compact JSON (utf-8)
+TAG_MSGPACK = b'M'      # msgpack
+TAG_ZJSON = b'j'        # zlib compressed compact JSON
+TAG_ZMSGPACK = b'm'     # zlib compressed msgpack
+
+COMPRESSED = {TAG_ZJSON: TAG_JSON, TAG_ZMSGPACK: TAG_MSGPACK}
+
+
+def _dump_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _load_json(payload):
+    return json.loads(payload)
+
+
+def _dump_msgpack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _load_msgpack(payload):
+    if msgpack is None:
+        raise RuntimeError('msgpack encoded ticket found but "msgpack" is not installed')
+    return msgpack.unpackb(payload, raw=False)
+
+
+DUMPERS = {TAG_JSON: _dump_json, TAG_MSGPACK: _dump_msgpack}
+LOADERS = {TAG_JSON: _load_json, TAG_MSGPACK: _load_msgpack}
+
+
+class TicketCodec:
+    """ Encode/decode ticket blobs.
+
+    format - 'json' (legacy untagged JSON text), 'compact' (tagged compact
+             JSON) or 'msgpack'
+    compress_min - zlib compress tagged payloads at least this many bytes
+
+    Any format can be decoded regardless of the format being written, so
+    the format can be changed while tickets written earlier are still live.
+    """
+
+    FORMATS = {'json': None, 'compact': TAG_JSON, 'msgpack': TAG_MSGPACK}
+
+    def __init__(self, format='json', compress_min=None):
+
+        if format not in self.FORMATS:
+            raise ValueError(f'Unknown cas_ticket_codec "{format}"')
+
+        if format == 'msgpack' and msgpack is None:
+            raise RuntimeError('cas_ticket_codec "msgpack" requires the "msgpack" package')
+
+        self.format = format
+        self.tag = self.FORMATS[format]
+        self.compress_min = compress_min
+
+    def encode(self, obj):
+        """ Serialize a ticket. """
+
+        if self.tag is None:
+            return json.dumps(obj)
+
+        tag = self.tag
+        payload = DUMPERS[tag](obj)
+        if self.compress_min is not None and len(payload) >= self.compress_min:
+            payload = zlib.compress(payload, 1)
+            tag = tag.lower()
+
+        return MARK + tag + payload
+
+    def decode(self, blob):
+        """ Deserialize a ticket in any supported format. """
+
+        if isinstance(blob, (bytes, bytearray, memoryview)):
+            blob = bytes(blob)
+            if blob[:1] == MARK:
+                tag, payload = blob[1:2], blob[2:]
+                if tag in COMPRESSED:
+                    tag, payload = COMPRESSED[tag], zlib.decompress(payload)
+                if tag not in LOADERS:
+                    raise ValueError(f'Unknown ticket format tag {tag!r}')
+                return LOADERS[tag](payload)
+
+        # legacy JSON text
+        return json.loads(blob)
@@ -0,0 +1,96 @@
+"""
+    Bottle CAS Server - Background expired ticket reaper
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TicketReaper:
+    """ Sweeps expired tickets and index entries off the request path.
+
+    Each cycle asks the store to reap() at most `batch` entries. When the
+    store reports more work in the current sweep the next cycle follows
+    after a short pause rather than the full interval.
+    """
+
+    def __init__(self, store, interval=60, batch=1000, pause=None):
+
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self.pause = interval / 10 if pause is None else pause
+
+        # metrics
+        self.cycles = 0
+        self.removed = 0
+        self.errors = 0
+        self.backlog = None
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_run = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """ One bounded reap cycle - returns (removed, backlog). """
+
+        started = time.perf_counter()
+        try:
+            removed, backlog = self.store.reap(self.batch)
+        except Exception:
+            self.errors += 1
+            log.exception('CAS: ticket reaper cycle failed')
+            removed, backlog = 0, 0
+
+        elapsed = time.perf_counter() - started
+        self.cycles += 1
+        self.removed += removed
+        self.backlog = backlog
+        self.last_duration = elapsed
+        self.max_duration = max(self.max_duration, elapsed)
+        self.last_run = time.time()
+
+        if removed:
+            log.debug(f'CAS: reaped {removed} expired entries in {elapsed*1000:.1f}ms (backlog {backlog})')
+
+        return removed, backlog
+
+    def _run(self):
+
+        while not self._stop.is_set():
+            _, backlog = self.run_once()
+            # backlog None - the store can't tell, assume more
+            self._stop.wait(self.interval if backlog == 0 else self.pause)
+
+    def start(self):
+        """ Start the reaper thread (once). """
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cas-ticket-reaper', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """ Stop the reaper thread. """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        """ Reaper metrics. """
+
+        return {
+            'cycles': self.cycles,
+            'removed': self.removed,
+            'errors': self.errors,
+            'backlog': self.backlog,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'last_run': self.last_run,
+        }
@@ -0,0 +1,177 @@
+"""
+    Bottle CAS Server - Signed (store-free) service and proxy tickets
+"""
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+VERSION = 1
+
+# version, flags, expiry (unix seconds), nonce - tickets for the same
+# service and TGT within a second still differ
+HEADER = struct.Struct('>BBI8s')
+
+FLAG_PROXY = 1
+FLAG_RENEWED = 2
+SUFFIX_SHIFT = 2        # remaining flag bits - length of the granting id's placement suffix
+
+TAG_SIZE = 16           # truncated HMAC-SHA256
+ID_SIZE = 32            # random part of a TGT-/PGT- id (token_urlsafe())
+MAX_TICKET = 256        # CAS protocol: clients must accept tickets up to 256 characters
+MAX_SUFFIX = 32         # placement suffix of a sharded store's ids ('.<slot>')
+RANDOM_TICKET = 64      # 'ST-' + token_urlsafe() (+ suffix) - stored tickets are never longer
+
+# a service ticket refers to its TGT, a proxy ticket to its PGT
+GRANTING_PREFIX = {'ST-': 'TGT-', 'PT-': 'PGT-'}
+
+
+def b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def xor(data, pad):
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(pad[:len(data)], 'big')).to_bytes(len(data), 'big')
+
+
+class TicketSigner:
+    """ Service/proxy tickets that carry their own content.
+
+        ST-|PT- base64url(header | tag | sealed granting id | service)
+
+    tag is an HMAC over the prefix, header, granting ticket id and service;
+    the granting id (and any placement suffix a ShardedTicketStore gave it)
+    is XORed with a pad derived from the tag (SIV style), so
+    the TGT/PGT id isn't disclosed to the service. Everything else about
+    the ticket (user, attributes, proxies) comes from the granting ticket
+    when it is validated, so revoking that revokes its tickets.
+
+    secrets - one secret, or a list whose first entry signs and all verify
+              (for rotation); shared by every server validating tickets
+    """
+
+    def __init__(self, secrets):
+
+        if isinstance(secrets, (str, bytes)):
+            secrets = [secrets]
+        if not secrets:
+            raise ValueError('cas_stateless_tickets requires a cas_ticket_secret')
+
+        self.keys = [self.derive_keys(secret) for secret in secrets]
+
+    @staticmethod
+    def derive_keys(secret):
+        """ (mac key, pad key) for a secret. """
+
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        return (
+            hmac.new(secret, b'cas-ticket-mac', hashlib.sha256).digest(),
+            hmac.new(secret, b'cas-ticket-pad', hashlib.sha256).digest(),
+        )
+
+    @staticmethod
+    def _tag(mac_key, prefix, header, granting_id, service):
+
+        return hmac.new(
+            mac_key, prefix.encode('ascii') + header + granting_id + service, hashlib.sha256
+        ).digest()[:TAG_SIZE]
+
+    @staticmethod
+    def _pad(pad_key, tag):
+        return hmac.new(pad_key, tag, hashlib.sha512).digest()
+
+    def issue(self, prefix, granted_by, service, life, renewed=False):
+        """ Signed ticket, or None if it can't be represented (use a stored ticket). """
+
+        if not granted_by or not granted_by.startswith(GRANTING_PREFIX[prefix]):
+            return None
+
+        ref, dot, placement = granted_by[4:].partition('.')
+        try:
+            granting_id = b64decode(ref)
+        except ValueError:
+            return None
+        if len(granting_id) != ID_SIZE or b64encode(granting_id) != ref:
+            return None
+
+        suffix = (dot + placement).encode('ascii')
+        if len(suffix) > MAX_SUFFIX:
+            return None
+        granting_id += suffix
+
+        flags = (FLAG_PROXY if prefix == 'PT-' else 0) | (FLAG_RENEWED if renewed else 0)
+        flags |= len(suffix) << SUFFIX_SHIFT
+        header = HEADER.pack(VERSION, flags, int(time.time() + life), os.urandom(8))
+        service = service.encode('utf-8')
+
+        mac_key, pad_key = self.keys[0]
+        tag = self._tag(mac_key, prefix, header, granting_id, service)
+        ticket = prefix + b64encode(header + tag + xor(granting_id, self._pad(pad_key, tag)) + service)
+
+        # long service URLs don't fit
+        return ticket if len(ticket) <= MAX_TICKET else None
+
+    @staticmethod
+    def is_signed(ticket):
+        """ Signed tickets are longer than any stored ticket. """
+
+        return ticket is not None and len(ticket) > RANDOM_TICKET
+
+    def open(self, ticket):
+        """ Content of a genuine, unexpired ticket or None.
+
+        Returns {granted_by, service, proxy, renewed, spent_key, spent_life}.
+        """
+
+        prefix = ticket[:3]
+        if prefix not in GRANTING_PREFIX or len(ticket) > MAX_TICKET:
+            return None
+
+        try:
+            blob = b64decode(ticket[3:])
+        except ValueError:
+            return None
+
+        if len(blob) < HEADER.size + TAG_SIZE + ID_SIZE:
+            return None
+
+        header = blob[:HEADER.size]
+        version, flags, expires, _ = HEADER.unpack(header)
+        if version != VERSION:
+            return None
+
+        fixed = HEADER.size + TAG_SIZE + ID_SIZE + (flags >> SUFFIX_SHIFT)
+        if len(blob) < fixed:
+            return None
+
+        tag = blob[HEADER.size:HEADER.size + TAG_SIZE]
+        sealed = blob[HEADER.size + TAG_SIZE:fixed]
+        service = blob[fixed:]
+
+        for mac_key, pad_key in self.keys:
+            granting_id = xor(sealed, self._pad(pad_key, tag))
+            if hmac.compare_digest(tag, self._tag(mac_key, prefix, header, granting_id, service)):
+                break
+        else:
+            return None
+
+        now = time.time()
+        if expires <= now:
+            return None
+
+        return {
+            'granted_by': GRANTING_PREFIX[prefix] + b64encode(granting_id[:ID_SIZE]) + granting_id[ID_SIZE:].decode('ascii'),
+            'service': service.decode('utf-8'),
+            'proxy': bool(flags & FLAG_PROXY),
+            'renewed': bool(flags & FLAG_RENEWED),
+            # one-shot: validation records the ticket as spent until it expires
+            'spent_key': 'SPENT-' + b64encode(tag),
+            'spent_life': int(expires - now) + 1,
+        }
@@ -0,0 +1,1464 @@
+"""
+    Bottle CAS Server - Ticket Stores
+"""
+import hashlib
+import json
+import os
+import pickle
+import re
+import sqlite3
+import struct
+import threading
+from bisect import bisect_left
+from secrets import randbelow, token_hex, token_urlsafe
+from time import time
+
+try:
+    from cachelib import SimpleCache, FileSystemCache, RedisCache
+except ImportError:     # pragma: no cover - cachelib comes with flask-session
+    SimpleCache = FileSystemCache = RedisCache = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# errors meaning GETDEL is unavailable (client or server too old)
+GETDEL_ERRORS = (AttributeError,) + ((redis.exceptions.ResponseError,) if redis else ())
+
+# Store capabilities
+ATOMIC_CLAIM = 'atomic_claim'   # claim() is a single one-shot operation
+BATCH_DELETE = 'batch_delete'   # delete_many() is a single round trip
+TTL = 'ttl'                     # entries expire on their own
+INDEX = 'index'                 # native (atomic) ticket indexes
+LOCAL = 'local'                 # held in this process - never shared with another worker
+
+
+# Lua fallback for Redis servers older than 6.2 (no GETDEL)
+REDIS_CLAIM_SCRIPT = """
+local v = redis.call('GET', KEYS[1])
+if v then redis.call('DEL', KEYS[1]) end
+return v
+"""
+
+# add an index member, drop expired ones, and keep the index alive as long
+# as its longest lived member: KEYS[1] index, ARGV now, expires, member
+REDIS_INDEX_ADD_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local top = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if top[2] == 'inf' then
+    redis.call('PERSIST', KEYS[1])
+else
+    redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(top[2])) + 1)
+end
+"""
+
+# serializes claims on SimpleCache versions that have no lock of their own
+_simple_lock = threading.Lock()
+
+
+def claim(db, key):
+    """ Atomically fetch and remove key from db - returns None if absent. """
+
+    if not key:
+        return None
+
+    if hasattr(db, 'claim'):
+        # store provides its own claim primitive
+        return db.claim(key)
+
+    if RedisCache is not None and isinstance(db, RedisCache):
+        return _claim_redis(db, key)
+
+    if FileSystemCache is not None and isinstance(db, FileSystemCache):
+        return _claim_filesystem(db, key)
+
+    if SimpleCache is not None and isinstance(db, SimpleCache):
+        return _claim_simple(db, key)
+
+    # fallback - two round trips, no one-shot guarantee under concurrency
+    value = db.get(key)
+    if value is not None:
+        db.delete(key)
+    return value
+
+
+def _claim_redis(db, key):
+    """ GETDEL (or Lua GET+DEL) on a cachelib RedisCache. """
+
+    prefix = db._get_prefix() if hasattr(db, '_get_prefix') else (db.key_prefix or '')
+    name = prefix + key
+    client = db._write_client
+
+    raw = None
+    if getattr(db, '_cas_getdel', True):
+        try:
+            raw = client.getdel(name)
+        except GETDEL_ERRORS:
+            # server (< 6.2) or client lacks GETDEL - use the script from now on
+            db._cas_getdel = False
+
+    if not getattr(db, '_cas_getdel', True):
+        script = getattr(db, '_cas_claim_script', None)
+        if script is None:
+            script = db._cas_claim_script = client.register_script(REDIS_CLAIM_SCRIPT)
+        raw = script(keys=[name])
+
+    return db.serializer.loads(raw) if hasattr(db, 'serializer') else db.load_object(raw)
+
+
+def _claim_filesystem(db, key):
+    """ Rename-then-read on a cachelib FileSystemCache. """
+
+    filename = db._get_filename(key)
+    # the transaction suffix keeps the claimed file out of cachelib's pruning
+    claimed = f'{filename}.{token_hex(4)}{db._fs_transaction_suffix}'
+
+    try:
+        # rename is atomic - only one claimant can win
+        os.rename(filename, claimed)
+    except FileNotFoundError:
+        return None
+
+    try:
+        with open(claimed, 'rb') as f:
+            expires = struct.unpack('I', f.read(4))[0]
+            if expires != 0 and expires < time():
+                return None
+            if hasattr(db, 'serializer'):
+                return db.serializer.load(f)
+            return pickle.load(f)
+
+    except (OSError, EOFError, struct.error, pickle.PickleError):
+        return None
+
+    finally:
+        try:
+            os.remove(claimed)
+            if hasattr(db, '_update_count'):
+                db._update_count(delta=-1)
+        except OSError:
+            pass
+
+
+def _claim_simple(db, key):
+    """ Locked pop on a cachelib SimpleCache. """
+
+    with getattr(db, '_lock', _simple_lock):
+        item = db._cache.pop(key, None)
+
+    if item is None:
+        return None
+
+    expires, value = item
+    if expires != 0 and expires <= time():
+        return None
+
+    return db.serializer.loads(value) if hasattr(db, 'serializer') else pickle.loads(value)
+
+
+class TicketStore:
+    """ Base class for CAS ticket backing stores.
+
+    Stores keep opaque ticket blobs (str or bytes) by key with a lifetime in
+    seconds; a timeout of None uses the store default and 0 never expires.
+    """
+
+    capabilities = frozenset()
+
+    def __init__(self, default_timeout=300):
+
+        self.default_timeout = default_timeout
+
+        # serialize index read-modify-writes within this process
+        self._index_locks = [threading.Lock() for _ in range(16)]
+
+    def _expires(self, timeout):
+        """ Absolute expiry time for timeout (0 - never). """
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout else 0
+
+    def supports(self, capability):
+        """ Does this store provide capability? """
+
+        return capability in self.capabilities
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_many(self, *keys):
+        """ Remove several keys - returns the number removed. """
+
+        return sum(1 for key in keys if self.delete(key))
+
+    def new_key(self, prefix, affinity=None):
+        """ New random ticket id.
+
+        affinity - a key the ticket is used with (e.g. its TGT); stores that
+                   place keys (ShardedTicketStore) put the ticket beside it
+        """
+
+        return prefix + token_urlsafe()
+
+    def add(self, key, value, timeout=None):
+        """ Set key only if absent - returns True if set (not atomic unless overridden). """
+
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+    def claim(self, key):
+        """ Fetch and remove key (not atomic unless overridden). """
+
+        value = self.get(key)
+        if value is not None:
+            self.delete(key)
+        return value
+
+    def reap(self, limit=1000):
+        """ Remove expired entries, examining at most about limit of them.
+
+        Returns (removed, backlog) - backlog is the work known to remain in
+        the current sweep (0 - sweep finished, None - unknown).
+        """
+
+        return 0, 0
+
+    def defer_pruning(self):
+        """ Leave expiry to reap() - stop any full prune inline with writes. """
+
+    def size(self):
+        """ Number of stored entries, or None if the store can't tell cheaply. """
+
+        return None
+
+#
+# Ticket indexes - sets of ticket keys (e.g. a user's PGTs) whose members
+# each expire with their ticket. The base implementation keeps the set as
+# a JSON {member: expires} blob, serialized per process only; stores with
+# the INDEX capability do better.
+#
+    def _index_lock(self, index):
+        return self._index_locks[hash(index) % len(self._index_locks)]
+
+    def _index_load(self, index, now):
+        """ Live {member: expires} for index. """
+
+        blob = self.get(index)
+        if not blob:
+            return {}
+        members = json.loads(blob)
+        if isinstance(members, list):
+            # pre-index format: a plain list of keys
+            return dict.fromkeys(members, 0)
+        return {m: exp for m, exp in members.items() if not exp or exp > now}
+
+    def index_add(self, index, member, timeout=None):
+        """ Add member to index - it is dropped when timeout expires. """
+
+        now = time()
+        expires = self._expires(timeout)
+        with self._index_lock(index):
+            members = self._index_load(index, now)
+            members[member] = expires
+            longest = max(members.values())
+            life = 0 if not longest else max(1, int(longest - now) + 1)
+            self.set(index, json.dumps(members), life)
+
+    def index_members(self, index):
+        """ Unexpired members of index. """
+
+        return list(self._index_load(index, time()))
+
+    def index_purge(self, *indexes, keys=()):
+        """ Delete indexes, their members and keys in one batch - returns the number removed. """
+
+        now = time()
+        members = []
+        for index in indexes:
+            with self._index_lock(index):
+                members += self._index_load(index, now)
+        return self.delete_many(*indexes, *members, *keys)
+
+    def set_indexed(self, key, value, timeout, index, index_timeout=None):
+        """ Set key and add it to index. """
+
+        self.set(key, value, timeout)
+        self.index_add(index, key, timeout if index_timeout is None else index_timeout)
+
+
+class CachelibTicketStore(TicketStore):
+    """ Adapter for a cachelib cache (e.g. the flask-session cache). """
+
+    def __init__(self, cache):
+
+        super().__init__(getattr(cache, 'default_timeout', 300))
+        self.cache = cache
+
+        # a RedisCache gets native (sorted set) indexes, as RedisTicketStore
+        self._redis = RedisCache is not None and isinstance(cache, RedisCache)
+        self._index_script = None
+
+        caps = {TTL}
+        if any(kind is not None and isinstance(cache, kind)
+                for kind in (SimpleCache, FileSystemCache, RedisCache)):
+            caps.add(ATOMIC_CLAIM)
+        if SimpleCache is not None and isinstance(cache, SimpleCache):
+            caps.add(LOCAL)
+        if self._redis:
+            caps.update((BATCH_DELETE, INDEX))
+        self.capabilities = frozenset(caps)
+
+    def _redis_name(self, key):
+        """ Redis key of a RedisCache entry. """
+
+        cache = self.cache
+        prefix = cache._get_prefix() if hasattr(cache, '_get_prefix') else (cache.key_prefix or '')
+        return prefix + key
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        return self.cache.set(key, value, timeout)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+    def delete_many(self, *keys):
+
+        if not keys:
+            return 0
+        if self._redis:
+            return self.cache._write_client.delete(*[self._redis_name(key) for key in keys])
+        if FileSystemCache is not None and isinstance(self.cache, FileSystemCache):
+            return self._delete_files(keys)
+        # cachelib's delete_many() counts absent keys as deleted
+        return sum(1 for key in keys if self.cache.delete(key))
+
+    def _delete_files(self, keys):
+        """ Remove FileSystemCache entries - FileSystemCache.delete() is True for missing files too. """
+
+        removed = 0
+        for key in keys:
+            try:
+                os.remove(self.cache._get_filename(key))
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            self.cache._update_count(delta=-removed)
+        return removed
+
+    def add(self, key, value, timeout=None):
+
+        if self.cache.add(key, value, timeout):
+            return True
+        if FileSystemCache is not None and isinstance(self.cache, FileSystemCache) and not self.cache.has(key):
+            # an expired file still blocks FileSystemCache.add
+            return bool(self.cache.set(key, value, timeout))
+        return False
+
+    def claim(self, key):
+        return claim(self.cache, key)
+
+    def index_add(self, index, member, timeout=None):
+
+        if not self._redis:
+            # JSON blob - members added by other processes at once can be lost
+            return super().index_add(index, member, timeout)
+
+        client = self.cache._write_client
+        if self._index_script is None:
+            self._index_script = client.register_script(REDIS_INDEX_ADD_SCRIPT)
+
+        expires = self._expires(timeout) or '+inf'
+        self._index_script(keys=[self._redis_name(index)], args=[time(), expires, member])
+
+    def index_members(self, index):
+
+        if not self._redis:
+            return super().index_members(index)
+
+        members = self.cache._read_client.zrangebyscore(self._redis_name(index), time(), '+inf')
+        return [m.decode('utf-8') if isinstance(m, bytes) else m for m in members]
+
+    def index_purge(self, *indexes, keys=()):
+
+        if not self._redis:
+            return super().index_purge(*indexes, keys=keys)
+
+        # one round trip to read every index, one to delete everything
+        now = time()
+        client = self.cache._write_client
+        pipe = client.pipeline(transaction=False)
+        for index in indexes:
+            pipe.zrangebyscore(self._redis_name(index), now, '+inf')
+        members = [
+            m.decode('utf-8') if isinstance(m, bytes) else m
+            for found in pipe.execute() for m in found
+        ]
+        names = [self._redis_name(key) for key in (*indexes, *members, *keys)]
+        return client.delete(*names) if names else 0
+
+    def reap(self, limit=1000):
+
+        if FileSystemCache is not None and isinstance(self.cache, FileSystemCache):
+            return self._reap_files(limit)
+        if SimpleCache is not None and isinstance(self.cache, SimpleCache):
+            return self._reap_simple(limit)
+        # the cache expires entries itself (e.g. redis)
+        return 0, 0
+
+    def _sweep(self, names):
+        """ Names left in the current sweep - a new sweep starts when it is done. """
+
+        sweep = getattr(self, '_sweep_names', None)
+        if not sweep:
+            sweep = self._sweep_names = names()
+        return sweep
+
+    def _reap_files(self, limit):
+        """ Incremental expiry scan of a FileSystemCache directory. """
+
+        cache = self.cache
+        sweep = self._sweep(lambda: [
+            fn for fn in os.listdir(cache._path) if not cache._is_mgmt(fn)])
+
+        removed = 0
+        now = time()
+        for _ in range(min(limit, len(sweep))):
+            filename = os.path.join(cache._path, sweep.pop())
+            try:
+                with open(filename, 'rb') as f:
+                    expires = struct.unpack('I', f.read(4))[0]
+                if expires and expires < now:
+                    os.remove(filename)
+                    removed += 1
+            except (OSError, struct.error):
+                # gone already, or being written - next sweep
+                pass
+
+        if removed:
+            cache._update_count(delta=-removed)
+        return removed, len(sweep)
+
+    def _reap_simple(self, limit):
+        """ Incremental expiry scan of a SimpleCache. """
+
+        cache = self.cache
+        sweep = self._sweep(lambda: list(cache._cache))
+
+        removed = 0
+        now = time()
+        with cache._lock:
+            for _ in range(min(limit, len(sweep))):
+                key = sweep.pop()
+                item = cache._cache.get(key)
+                if item is not None and item[0] and item[0] < now:
+                    del cache._cache[key]
+                    removed += 1
+        return removed, len(sweep)
+
+    def defer_pruning(self):
+
+        if FileSystemCache is not None and isinstance(self.cache, FileSystemCache):
+            # threshold 0 - no prune (a full directory scan) on set()
+            self.cache._threshold = 0
+
+    def size(self):
+
+        if SimpleCache is not None and isinstance(self.cache, SimpleCache):
+            return len(self.cache._cache)
+        if FileSystemCache is not None and isinstance(self.cache, FileSystemCache):
+            # cachelib's own count stops being kept up once pruning is deferred
+            cache = self.cache
+            return sum(
+                1 for fn in os.listdir(cache._path)
+                if not cache._is_mgmt(fn) and not fn.endswith(cache._fs_transaction_suffix))
+        return None
+
+
+class _Entry:
+    """ A stored value and its expiry (0 - never). """
+
+    __slots__ = ('expires', 'value', 'size')
+
+    def __init__(self, expires, value):
+        self.expires = expires
+        self.value = value
+        self.size = len(value) if isinstance(value, (str, bytes)) else 0
+
+
+# estimated memory per index member besides its key (dict slot, str header, expiry)
+INDEX_MEMBER_BYTES = 96
+
+
+def _member_size(member):
+    return INDEX_MEMBER_BYTES + len(member)
+
+
+class _IndexEntry:
+    """ An index - {member: expires} and the member count of the next prune.
+
+    size is the estimated bytes of its members.
+    """
+
+    __slots__ = ('expires', 'value', 'size', 'prune_at')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.value = {}
+        self.size = 0
+        self.prune_at = 32
+
+
+class _Shard:
+    """ One lock stripe - entries, its timer wheel and counters. """
+
+    __slots__ = ('lock', 'entries', 'wheel', 'tick', 'bytes',
+            'hits', 'misses', 'expired', 'evicted')
+
+    def __init__(self, slots, tick):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.wheel = [set() for _ in range(slots)]
+        self.tick = tick            # next wheel tick to expire
+        self.bytes = 0
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+
+class MemoryTicketStore(TicketStore):
+    """ Lock-striped in-process ticket store with TTL.
+
+    Keys hash to one of `shards` stripes, each with its own lock, so
+    threads only contend on the same stripe. Expiring entries are also
+    filed in a hashed timer wheel (`wheel_slots` slots of `resolution`
+    seconds). Writes turn a stripe's wheel once per tick, and reap() and
+    prune() turn every stripe, each visiting only the slots that have come
+    due rather than every entry - so expired entries don't outlive the next
+    write to their stripe, with or without a reaper.
+
+    max_entries / max_bytes bound the store (bytes counts str/bytes values
+    and an estimate per index member). When a write would exceed a bound the
+    `eviction` policy applies:
+    'lru' drops the least recently used entries, 'fifo' the oldest written
+    and 'none' refuses the write (set() returns False).
+    """
+
+    capabilities = frozenset({ATOMIC_CLAIM, BATCH_DELETE, TTL, INDEX, LOCAL})
+
+    EVICTION = ('lru', 'fifo', 'none')
+
+    def __init__(self, shards=16, default_timeout=300, max_entries=None,
+            max_bytes=None, eviction='lru', wheel_slots=512, resolution=1.0):
+
+        super().__init__(default_timeout)
+
+        if eviction not in self.EVICTION:
+            raise ValueError(f'Unknown MemoryTicketStore eviction "{eviction}"')
+
+        self.eviction = eviction
+        self.resolution = resolution
+        # bounds are enforced per stripe
+        self._max_entries = max_entries and max(1, max_entries // shards)
+        self._max_bytes = max_bytes and max(1, max_bytes // shards)
+
+        tick = int(time() // resolution)
+        self._shards = [_Shard(wheel_slots, tick) for _ in range(shards)]
+        self._reap_cursor = 0
+
+    def _shard(self, key):
+        """ Stripe owning key. """
+
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _slot(self, shard, expires):
+        return shard.wheel[int(expires // self.resolution) % len(shard.wheel)]
+
+    # entry bookkeeping - caller holds shard.lock
+
+    def _insert(self, shard, key, entry):
+
+        now = time()
+        if int(now // self.resolution) > shard.tick:
+            # amortized expiry - a write per stripe per tick turns the wheel
+            self._advance(shard, now)
+
+        old = shard.entries.pop(key, None)
+        if old is not None:
+            self._forget(shard, key, old)
+
+        if not self._make_room(shard, entry.size):
+            return False
+
+        shard.entries[key] = entry
+        shard.bytes += entry.size
+        if entry.expires:
+            self._slot(shard, entry.expires).add(key)
+        return True
+
+    def _forget(self, shard, key, entry):
+
+        shard.bytes -= entry.size
+        if entry.expires:
+            self._slot(shard, entry.expires).discard(key)
+
+    def _remove(self, shard, key):
+
+        entry = shard.entries.pop(key, None)
+        if entry is not None:
+            self._forget(shard, key, entry)
+        return entry
+
+    def _make_room(self, shard, size):
+        """ Evict per policy until an entry of size fits. """
+
+        entries = shard.entries
+        while ((self._max_entries and len(entries) >= self._max_entries)
+                or (self._max_bytes and entries and shard.bytes + size > self._max_bytes)):
+            if self.eviction == 'none':
+                return False
+            # dicts keep insertion order - lru moves entries to the end on use
+            key = next(iter(entries))
+            self._forget(shard, key, entries.pop(key))
+            shard.evicted += 1
+        return True
+
+    def _grow(self, shard, key, entry, size):
+        """ Charge a stored entry size more bytes, evicting others per policy. """
+
+        if self._max_bytes:
+            # the entry itself is no candidate for eviction
+            del shard.entries[key]
+            fits = self._make_room(shard, size) and shard.bytes + size <= self._max_bytes
+            shard.entries[key] = entry
+            if not fits:
+                # nothing left to evict but the index - the member isn't tracked
+                return False
+
+        entry.size += size
+        shard.bytes += size
+        return True
+
+    def _prune_members(self, shard, entry, now):
+        """ Drop an index's expired members. """
+
+        members = entry.value
+        expired = [m for m, exp in members.items() if exp and exp <= now]
+        for m in expired:
+            del members[m]
+        freed = sum(map(_member_size, expired))
+        entry.size -= freed
+        shard.bytes -= freed
+
+    def _live(self, shard, key, now):
+        """ Unexpired entry for key (expired entries are dropped). """
+
+        entry = shard.entries.get(key)
+        if entry is not None and entry.expires and entry.expires <= now:
+            self._remove(shard, key)
+            shard.expired += 1
+            entry = None
+        return entry
+
+    def _advance(self, shard, now):
+        """ Expire entries in the wheel slots that have come due. """
+
+        removed = 0
+        due = int(now // self.resolution)
+        slots = len(shard.wheel)
+        # a full revolution visits every slot
+        for tick in range(max(shard.tick, due - slots + 1), due + 1):
+            slot = shard.wheel[tick % slots]
+            if not slot:
+                continue
+            expired = [k for k in slot if shard.entries[k].expires <= now]
+            for key in expired:
+                self._remove(shard, key)
+            removed += len(expired)
+        # the current tick is only partly due - revisit it next time
+        shard.tick = due
+        shard.expired += removed
+        return removed
+
+    # TicketStore
+
+    def get(self, key):
+
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key, time())
+            if entry is None:
+                shard.misses += 1
+                return None
+            shard.hits += 1
+            if self.eviction == 'lru':
+                shard.entries[key] = shard.entries.pop(key)
+            return entry.value
+
+    def set(self, key, value, timeout=None):
+
+        shard = self._shard(key)
+        with shard.lock:
+            return self._insert(shard, key, _Entry(self._expires(timeout), value))
+
+    def delete(self, key):
+
+        shard = self._shard(key)
+        with shard.lock:
+            return self._remove(shard, key) is not None
+
+    def add(self, key, value, timeout=None):
+
+        shard = self._shard(key)
+        with shard.lock:
+            if self._live(shard, key, time()) is not None:
+                return False
+            return self._insert(shard, key, _Entry(self._expires(timeout), value))
+
+    def claim(self, key):
+
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._remove(shard, key)
+            if entry is None or (entry.expires and entry.expires <= time()):
+                shard.misses += 1
+                return None
+            shard.hits += 1
+            return entry.value
+
+    def index_add(self, index, member, timeout=None):
+
+        now = time()
+        expires = self._expires(timeout)
+        shard = self._shard(index)
+        with shard.lock:
+            entry = self._live(shard, index, now)
+            if not isinstance(entry, _IndexEntry):
+                entry = _IndexEntry(expires)
+                if not self._insert(shard, index, entry):
+                    return
+
+            members = entry.value
+            if member not in members and not self._grow(shard, index, entry, _member_size(member)):
+                return
+            members[member] = expires
+
+            # index lives as long as its longest lived member
+            if entry.expires and (not expires or expires > entry.expires):
+                self._slot(shard, entry.expires).discard(index)
+                entry.expires = expires
+                if expires:
+                    self._slot(shard, expires).add(index)
+
+            if len(members) >= entry.prune_at:
+                # amortized pruning of expired members
+                self._prune_members(shard, entry, now)
+                entry.prune_at = max(32, 2 * len(members))
+
+    def index_members(self, index):
+
+        now = time()
+        shard = self._shard(index)
+        with shard.lock:
+            entry = self._live(shard, index, now)
+            if not isinstance(entry, _IndexEntry):
+                return []
+            self._prune_members(shard, entry, now)
+            return list(entry.value)
+
+    def index_purge(self, *indexes, keys=()):
+
+        members = []
+        for index in indexes:
+            members += self.index_members(index)
+        return self.delete_many(*indexes, *members, *keys)
+
+    def delete_many(self, *keys):
+
+        removed = 0
+        for key in keys:
+            shard = self._shard(key)
+            with shard.lock:
+                removed += self._remove(shard, key) is not None
+        return removed
+
+    def prune(self):
+        """ Drop expired entries - returns the number removed. """
+
+        now = time()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                removed += self._advance(shard, now)
+        return removed
+
+    def reap(self, limit=1000):
+
+        # stripes at a time, resuming at the next stripe on each call
+        cursor = self._reap_cursor
+        removed = examined = 0
+        now = time()
+        while examined < limit and cursor < len(self._shards):
+            shard = self._shards[cursor]
+            with shard.lock:
+                examined += sum(map(len, shard.wheel))
+                removed += self._advance(shard, now)
+            cursor += 1
+
+        backlog = sum(sum(map(len, shard.wheel)) for shard in self._shards[cursor:])
+        self._reap_cursor = cursor if cursor < len(self._shards) else 0
+        return removed, backlog
+
+    def stats(self):
+        """ Entry, byte and hit/miss/expiry/eviction counts. """
+
+        totals = dict.fromkeys(
+            ('entries', 'bytes', 'hits', 'misses', 'expired', 'evicted'), 0)
+        now = time()
+        for shard in self._shards:
+            with shard.lock:
+                self._advance(shard, now)
+                totals['entries'] += len(shard.entries)
+                totals['bytes'] += shard.bytes
+                totals['hits'] += shard.hits
+                totals['misses'] += shard.misses
+                totals['expired'] += shard.expired
+                totals['evicted'] += shard.evicted
+        return totals
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def size(self):
+
+        # unexpired entries only
+        self.prune()
+        return len(self)
+
+
+class RedisTicketStore(TicketStore):
+    """ Redis ticket store using a shared connection pool.
+
+    Indexes are sorted sets scored by member expiry.
+    """
+
+    capabilities = frozenset({ATOMIC_CLAIM, BATCH_DELETE, TTL, INDEX})
+
+    def __init__(self, url='redis://localhost:6379/0', max_connections=50,
+            key_prefix='cas:', default_timeout=300, client=None, **kwargs):
+
+        super().__init__(default_timeout)
+
+        if client is None:
+            if redis is None:
+                raise RuntimeError('RedisTicketStore requires the "redis" package')
+            pool = redis.ConnectionPool.from_url(url, max_connections=max_connections, **kwargs)
+            client = redis.Redis(connection_pool=pool)
+
+        self.client = client
+        self.key_prefix = key_prefix
+        self._getdel = True
+        self._claim_script = None
+        self._index_script = None
+
+    def get(self, key):
+        return self.client.get(self.key_prefix + key)
+
+    def set(self, key, value, timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return self.client.set(self.key_prefix + key, value, ex=timeout or None)
+
+    def add(self, key, value, timeout=None):
+
+        if timeout is None:
+            timeout = self.default_timeout
+        return bool(self.client.set(self.key_prefix + key, value, ex=timeout or None, nx=True))
+
+    def delete(self, key):
+        return bool(self.client.delete(self.key_prefix + key))
+
+    def delete_many(self, *keys):
+        return self.client.delete(*[self.key_prefix + k for k in keys]) if keys else 0
+
+    def claim(self, key):
+
+        name = self.key_prefix + key
+        if self._getdel:
+            try:
+                return self.client.getdel(name)
+            except GETDEL_ERRORS:
+                # server (< 6.2) lacks GETDEL - use the script from now on
+                self._getdel = False
+
+        if self._claim_script is None:
+            self._claim_script = self.client.register_script(REDIS_CLAIM_SCRIPT)
+        return self._claim_script(keys=[name])
+
+    def index_add(self, index, member, timeout=None):
+
+        if self._index_script is None:
+            self._index_script = self.client.register_script(REDIS_INDEX_ADD_SCRIPT)
+
+        expires = self._expires(timeout) or '+inf'
+        self._index_script(keys=[self.key_prefix + index], args=[time(), expires, member])
+
+    def index_members(self, index):
+
+        members = self.client.zrangebyscore(self.key_prefix + index, time(), '+inf')
+        return [m.decode('utf-8') if isinstance(m, bytes) else m for m in members]
+
+    def index_purge(self, *indexes, keys=()):
+
+        # one round trip to read every index, one to delete everything
+        now = time()
+        pipe = self.client.pipeline(transaction=False)
+        for index in indexes:
+            pipe.zrangebyscore(self.key_prefix + index, now, '+inf')
+        members = [
+            m.decode('utf-8') if isinstance(m, bytes) else m
+            for found in pipe.execute() for m in found
+        ]
+        return self.delete_many(*indexes, *members, *keys)
+
+    def reap(self, limit=1000):
+
+        # keys expire in redis - trim expired members from the indexes
+        cursor, names = self.client.scan(
+            getattr(self, '_reap_cursor', 0),
+            match=self.key_prefix + '*', count=limit, _type='zset')
+        self._reap_cursor = int(cursor)
+
+        removed = 0
+        if names:
+            pipe = self.client.pipeline(transaction=False)
+            for name in names:
+                pipe.zremrangebyscore(name, '-inf', time())
+            removed = sum(pipe.execute())
+        return removed, 0 if not self._reap_cursor else None
+
+    def set_indexed(self, key, value, timeout, index, index_timeout=None):
+
+        if self._index_script is None:
+            self._index_script = self.client.register_script(REDIS_INDEX_ADD_SCRIPT)
+
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = self._expires(timeout if index_timeout is None else index_timeout) or '+inf'
+
+        # ticket write and index update share one round trip
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key_prefix + key, value, ex=timeout or None)
+        self._index_script(keys=[self.key_prefix + index], args=[time(), expires, key], client=pipe)
+        pipe.execute()
+
+
+class SqliteTicketStore(TicketStore):
+    """ Local SQLite store in WAL mode - suited to a single node with several workers.
+
+    Every `prune_every` writes (per process) drop a bounded batch of expired
+    rows, so the file stops growing without a reaper; defer_pruning() leaves
+    that to reap().
+    """
+
+    capabilities = frozenset({ATOMIC_CLAIM, BATCH_DELETE, TTL, INDEX})
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS tickets (key TEXT PRIMARY KEY, value BLOB, expires REAL);'
+        'CREATE TABLE IF NOT EXISTS ticket_index ('
+        ' idx TEXT, member TEXT, expires REAL, PRIMARY KEY (idx, member)) WITHOUT ROWID;'
+        'CREATE INDEX IF NOT EXISTS tickets_expires ON tickets (expires);'
+        'CREATE INDEX IF NOT EXISTS ticket_index_expires ON ticket_index (expires);'
+    )
+
+    def __init__(self, path='./cas_tickets.db', mmap_size=64*1024*1024, default_timeout=300,
+            prune_every=500):
+
+        super().__init__(default_timeout)
+        self.path = path
+        self.mmap_size = mmap_size
+        self.prune_every = prune_every
+        self._writes = 0
+        self._local = threading.local()
+
+        # DELETE ... RETURNING makes claims a single statement (sqlite >= 3.35)
+        self._returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        """ Connection for this thread. """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            self._local.conn = conn
+        return conn
+
+    def _wrote(self, conn):
+        """ Count a write - every prune_every writes prune a batch of expired rows. """
+
+        if self.prune_every:
+            self._writes += 1
+            if self._writes >= self.prune_every:
+                self._writes = 0
+                # twice the writes since the last batch - pruning keeps ahead of expiry
+                self._prune_batch(conn, time(), 2 * self.prune_every)
+
+    def _prune_batch(self, conn, now, limit):
+        """ Drop up to limit expired tickets and index members - returns the tickets removed. """
+
+        conn.execute(
+            'DELETE FROM ticket_index WHERE (idx, member) IN (SELECT idx, member FROM ticket_index'
+            ' WHERE expires != 0 AND expires <= ? LIMIT ?)', (now, limit))
+        return conn.execute(
+            'DELETE FROM tickets WHERE rowid IN (SELECT rowid FROM tickets'
+            ' WHERE expires != 0 AND expires <= ? LIMIT ?)', (now, limit)).rowcount
+
+    def get(self, key):
+
+        row = self._conn().execute(
+            'SELECT value FROM tickets WHERE key = ? AND (expires = 0 OR expires > ?)',
+            (key, time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, timeout=None):
+
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO tickets (key, value, expires) VALUES (?, ?, ?)',
+            (key, value, self._expires(timeout)))
+        self._wrote(conn)
+        return True
+
+    def add(self, key, value, timeout=None):
+
+        # an expired row counts as absent
+        conn = self._conn()
+        added = conn.execute(
+            'INSERT INTO tickets (key, value, expires) VALUES (?, ?, ?)'
+            ' ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires'
+            ' WHERE tickets.expires != 0 AND tickets.expires <= ?',
+            (key, value, self._expires(timeout), time())).rowcount > 0
+        self._wrote(conn)
+        return added
+
+    def delete(self, key):
+        return self._conn().execute('DELETE FROM tickets WHERE key = ?', (key,)).rowcount > 0
+
+    def delete_many(self, *keys):
+
+        if not keys:
+            return 0
+        marks = ','.join('?' * len(keys))
+        return self._conn().execute(f'DELETE FROM tickets WHERE key IN ({marks})', keys).rowcount
+
+    def claim(self, key):
+
+        conn = self._conn()
+        if self._returning:
+            row = conn.execute(
+                'DELETE FROM tickets WHERE key = ? RETURNING value, expires', (key,)).fetchone()
+        else:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT value, expires FROM tickets WHERE key = ?', (key,)).fetchone()
+                conn.execute('DELETE FROM tickets WHERE key = ?', (key,))
+            finally:
+                conn.execute('COMMIT')
+
+        if row is None:
+            return None
+        value, expires = row
+        return None if expires and expires <= time() else value
+
+    def index_add(self, index, member, timeout=None):
+
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO ticket_index (idx, member, expires) VALUES (?, ?, ?)',
+            (index, member, self._expires(timeout)))
+        self._wrote(conn)
+
+    def index_members(self, index):
+
+        rows = self._conn().execute(
+            'SELECT member FROM ticket_index WHERE idx = ? AND (expires = 0 OR expires > ?)',
+            (index, time())).fetchall()
+        return [row[0] for row in rows]
+
+    def index_purge(self, *indexes, keys=()):
+
+        conn = self._conn()
+        removed = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for index in indexes:
+                removed += conn.execute(
+                    'DELETE FROM tickets WHERE key IN (SELECT member FROM ticket_index WHERE idx = ?)',
+                    (index,)).rowcount
+                conn.execute('DELETE FROM ticket_index WHERE idx = ?', (index,))
+            if keys:
+                marks = ','.join('?' * len(keys))
+                removed += conn.execute(
+                    f'DELETE FROM tickets WHERE key IN ({marks})', keys).rowcount
+        finally:
+            conn.execute('COMMIT')
+        return removed
+
+    def set_indexed(self, key, value, timeout, index, index_timeout=None):
+
+        expires = self._expires(timeout)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO tickets (key, value, expires) VALUES (?, ?, ?)',
+                (key, value, expires))
+            conn.execute(
+                'INSERT OR REPLACE INTO ticket_index (idx, member, expires) VALUES (?, ?, ?)',
+                (index, key, expires if index_timeout is None else self._expires(index_timeout)))
+        finally:
+            conn.execute('COMMIT')
+        self._wrote(conn)
+
+    def prune(self):
+        """ Drop expired entries - returns the number removed. """
+
+        conn = self._conn()
+        now = time()
+        conn.execute('DELETE FROM ticket_index WHERE expires != 0 AND expires <= ?', (now,))
+        return conn.execute(
+            'DELETE FROM tickets WHERE expires != 0 AND expires <= ?', (now,)).rowcount
+
+    def reap(self, limit=1000):
+
+        conn = self._conn()
+        now = time()
+        removed = self._prune_batch(conn, now, limit)
+        backlog = conn.execute(
+            'SELECT COUNT(*) FROM tickets WHERE expires != 0 AND expires <= ?', (now,)).fetchone()[0]
+        return removed, backlog
+
+    def defer_pruning(self):
+        self.prune_every = 0
+
+    def size(self):
+        return self._conn().execute('SELECT COUNT(*) FROM tickets').fetchone()[0]
+
+
+#
+# Sharding - tickets spread over several stores by a consistent hash
+#
+SLOTS = 4096
+
+# placement tag of a ticket id issued by a sharded store: '<id>.<slot hex>'
+PLACEMENT_TAG = re.compile(r'\.([0-9a-f]{3})$')
+
+
+def _ring_point(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=4).digest(), 'big')
+
+
+def key_slot(key):
+    """ Hash slot of a key - its placement tag, else a hash of the key. """
+
+    tagged = PLACEMENT_TAG.search(key)
+    if tagged:
+        return int(tagged.group(1), 16)
+    return _ring_point(key) % SLOTS
+
+
+class HashRing:
+    """ Consistent hash ring of named stores, resolved to a slot -> store table.
+
+    Each store has `vnodes` points on the ring; a slot belongs to the first
+    point at or after it. Adding a store only moves the slots it takes over.
+    """
+
+    def __init__(self, stores, vnodes=160):
+
+        if not stores:
+            raise ValueError('ShardedTicketStore requires at least one node')
+
+        self.stores = dict(stores)
+        points = sorted(
+            (_ring_point(f'{name}#{i}'), name) for name in self.stores for i in range(vnodes))
+        positions = [point for point, _ in points]
+
+        step = 2 ** 32 // SLOTS
+        self.table = [
+            self.stores[points[bisect_left(positions, slot * step) % len(points)][1]]
+            for slot in range(SLOTS)
+        ]
+
+
+class ShardedTicketStore(TicketStore):
+    """ Tickets spread over several stores (e.g. Redis instances) by consistent hashing.
+
+    Keys map to one of SLOTS hash slots and the ring assigns slots to
+    stores. Ticket ids from new_key() carry the slot of their affinity key
+    ('.<slot>' suffix), so no directory is needed to find them and a TGT's
+    tickets, its revocation index and its user's PGT index (sessPGT:<user>)
+    share one store - set_indexed() and logout stay single-store operations.
+
+    nodes - {name: store} or a list (named node0, node1...); a store is a
+            TicketStore, a cachelib cache or a cas_ticket_store config dict
+    vnodes - ring points per node
+    handoff - seconds the previous layout is still read after add_node() or
+              remove_node() - the longest ticket life (def: 8 hours)
+
+    While a layout change hands off, reads fall back to the store that owned
+    a key before, and deletes and claims reach both, so no ticket is lost or
+    resurrected; new writes go to the new owner.
+    """
+
+    def __init__(self, nodes, vnodes=160, handoff=8*60*60, default_timeout=300):
+
+        super().__init__(default_timeout)
+
+        if not isinstance(nodes, dict):
+            nodes = {f'node{i}': node for i, node in enumerate(nodes)}
+
+        self.vnodes = vnodes
+        self.handoff = handoff
+        self.handoff_reads = 0
+
+        self._ring = HashRing({name: self._node(node) for name, node in nodes.items()}, vnodes)
+        self._previous = []     # (HashRing, until) - earlier layouts still handing off
+
+    @staticmethod
+    def _node(node):
+        return ticket_store_from_config(node) if isinstance(node, dict) else as_ticket_store(node)
+
+    @property
+    def nodes(self):
+        """ {name: store} of the current layout. """
+
+        return self._ring.stores
+
+    @property
+    def capabilities(self):
+        return frozenset.intersection(*(store.capabilities for store in self.nodes.values()))
+
+    def _owners(self, key):
+        """ Store owning key, then any earlier owners still handing off. """
+
+        slot = key_slot(key)
+        owner = self._ring.table[slot]
+        if not self._previous:
+            return (owner,)
+
+        owners = [owner]
+        now = time()
+        for ring, until in self._previous:
+            store = ring.table[slot]
+            if until > now and store not in owners:
+                owners.append(store)
+        return owners
+
+    def _group(self, keys):
+        """ {store: [keys]} - every store that may hold each key. """
+
+        groups = {}
+        for key in keys:
+            for store in self._owners(key):
+                groups.setdefault(store, []).append(key)
+        return groups
+
+    def _stores(self):
+        """ Every store still in use - current nodes and those handing off. """
+
+        stores = list(self.nodes.values())
+        now = time()
+        for ring, until in self._previous:
+            if until > now:
+                stores += [store for store in ring.stores.values() if store not in stores]
+        return stores
+
+    # layout changes
+
+    def _expire_handoffs(self, now):
+        self._previous = [(ring, until) for ring, until in self._previous if until > now]
+
+    def _relayout(self, stores):
+
+        now = time()
+        self._expire_handoffs(now)
+        self._previous.insert(0, (self._ring, now + self.handoff))
+        self._ring = HashRing(stores, self.vnodes)
+
+    def add_node(self, name, node):
+        """ Add a store - it takes over its share of the slots. """
+
+        if name in self.nodes:
+            raise ValueError(f'ShardedTicketStore already has a node "{name}"')
+        self._relayout({**self.nodes, name: self._node(node)})
+
+    def remove_node(self, name):
+        """ Stop placing keys on a store - it is read until the handoff ends. """
+
+        if name not in self.nodes:
+            raise ValueError(f'ShardedTicketStore has no node "{name}"')
+        self._relayout({n: store for n, store in self.nodes.items() if n != name})
+
+    def slot_share(self):
+        """ {name: fraction of the slots} of the current layout. """
+
+        counts = dict.fromkeys(self.nodes, 0)
+        names = {id(store): name for name, store in self.nodes.items()}
+        for store in self._ring.table:
+            counts[names[id(store)]] += 1
+        return {name: count / SLOTS for name, count in counts.items()}
+
+    # TicketStore
+
+    def new_key(self, prefix, affinity=None):
+
+        slot = key_slot(affinity) if affinity else randbelow(SLOTS)
+        return f'{prefix}{token_urlsafe()}.{slot:03x}'
+
+    def get(self, key):
+
+        owners = self._owners(key)
+        for store in owners:
+            value = store.get(key)
+            if value is not None:
+                if store is not owners[0]:
+                    self.handoff_reads += 1
+                return value
+        return None
+
+    def set(self, key, value, timeout=None):
+        return self._owners(key)[0].set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+
+        owners = self._owners(key)
+        if any(store.get(key) is not None for store in owners[1:]):
+            return False
+        return owners[0].add(key, value, timeout)
+
+    def delete(self, key):
+        return any([store.delete(key) for store in self._owners(key)])
+
+    def delete_many(self, *keys):
+        return sum(store.delete_many(*batch) for store, batch in self._group(keys).items())
+
+    def claim(self, key):
+
+        for store in self._owners(key):
+            value = store.claim(key)
+            if value is not None:
+                return value
+        return None
+
+    def index_add(self, index, member, timeout=None):
+        self._owners(index)[0].index_add(index, member, timeout)
+
+    def index_members(self, index):
+
+        owners = self._owners(index)
+        if len(owners) == 1:
+            return owners[0].index_members(index)
+        return list(dict.fromkeys(m for store in owners for m in store.index_members(index)))
+
+    def index_purge(self, *indexes, keys=()):
+
+        indexed = self._group(indexes)
+        members = [m for store, batch in indexed.items() for index in batch for m in store.index_members(index)]
+
+        # members are usually placed with their index - one purge per store
+        rest = self._group((*members, *keys))
+        removed = sum(
+            store.index_purge(*batch, keys=rest.pop(store, ())) for store, batch in indexed.items())
+        return removed + sum(store.delete_many(*batch) for store, batch in rest.items())
+
+    def set_indexed(self, key, value, timeout, index, index_timeout=None):
+
+        store = self._owners(key)[0]
+        if store is self._owners(index)[0]:
+            store.set_indexed(key, value, timeout, index, index_timeout)
+        else:
+            store.set(key, value, timeout)
+            self.index_add(index, key, timeout if index_timeout is None else index_timeout)
+
+    def reap(self, limit=1000):
+
+        self._expire_handoffs(time())
+        removed, backlog = 0, 0
+        for store in self._stores():
+            count, left = store.reap(limit)
+            removed += count
+            backlog = None if backlog is None or left is None else backlog + left
+        return removed, backlog
+
+    def defer_pruning(self):
+
+        for store in self._stores():
+            store.defer_pruning()
+
+    def size(self):
+
+        sizes = [store.size() for store in self._stores()]
+        return None if None in sizes else sum(sizes)
+
+    def stats(self):
+        """ Node and handoff counts, with the nodes' own counters summed. """
+
+        now = time()
+        totals = {
+            'nodes': len(self.nodes),
+            'handoffs': sum(1 for _, until in self._previous if until > now),
+            'handoff_reads': self.handoff_reads,
+        }
+        for store in self._stores():
+            if hasattr(store, 'stats'):
+                for name, value in store.stats().items():
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+STORE_TYPES = {
+    'memory': MemoryTicketStore,
+    'redis': RedisTicketStore,
+    'sqlite': SqliteTicketStore,
+    'sharded': ShardedTicketStore,
+}
+
+
+def ticket_store_from_config(store_config):
+    """ Build a TicketStore from a cas_ticket_store config dict. """
+
+    options = dict(store_config)
+    store_type = options.pop('store_type', 'memory')
+
+    if store_type not in STORE_TYPES:
+        raise ValueError(f'Unknown cas_ticket_store store_type "{store_type}"')
+
+    return STORE_TYPES[store_type](**options)
+
+
+def as_ticket_store(db):
+    """ Wrap a cachelib cache as a TicketStore (TicketStores pass through). """
+
+    if db is None or isinstance(db, TicketStore):
+        return db
+    return CachelibTicketStore(db)
@@ -1,48 +1,238 @@
 import json
+import os
+import sys
+import threading
+import time
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def fold(urn):
+    """ Case-fold a URN for matching (cached - the same URNs recur). """
+
+    return urn.lower()
+
+
+class URNmatcher:
+    """ Precompiled prefix matcher for a list of URNs.
+
+    URNs are lower-cased once and stored in a trie keyed by '/' separated
+    segments (scheme, host, path...). A candidate matches when it begins
+    with any listed URN, exactly as str.startswith would - every segment
+    but the URN's last must be equal, the last is itself a prefix.
+
+    Results are remembered per candidate (up to VERDICTS of them) - login
+    redirects repeat the same few services.
+    """
+
+    __slots__ = ('root', 'size', 'verdicts')
+
+    VERDICTS = 4096
+
+    def __init__(self, urn_list):
+
+        # node: [children {segment: node}, tails {last segment}, tail lengths]
+        self.root = [{}, set(), set()]
+        self.size = 0
+
+        for urn in urn_list:
+            node = self.root
+            *path, tail = fold(urn).split('/')
+            for segment in path:
+                node = node[0].setdefault(segment, [{}, set(), set()])
+            node[1].add(tail)
+            node[2].add(len(tail))
+            self.size += 1
+
+        self.verdicts = {}
+
+    def match(self, test_urn):
+        """ True if test_urn begins with a listed URN. """
+
+        verdict = self.verdicts.get(test_urn)
+        if verdict is None:
+            if len(self.verdicts) >= self.VERDICTS:
+                # bounded - arbitrary services can't grow it
+                self.verdicts.clear()
+            verdict = self.verdicts[test_urn] = self._match(test_urn)
+        return verdict
+
+    def _match(self, test_urn):
+
+        node = self.root
+        for segment in fold(test_urn).split('/'):
+            tails = node[1]
+            if tails:
+                for length in node[2]:
+                    if segment[:length] in tails:
+                        return True
+            node = node[0].get(segment)
+            if node is None:
+                return False
+
+        return False
+
 
 class URNmanager:
-    """ Mange white lists of URNs/URIs """       
+    """ Mange white lists of URNs/URIs """
 
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, reload_interval=None):
         """ Load (optional) service limits file. """
-        
+
         # note: not in current_app context
-        self.urn_list = None
+        self.filepath = filepath
+
+        # (urn_list, matcher) - replaced as a unit so readers never lock
+        self._compiled = (None, None)
+
+        # reload statistics
+        self.reload_count = 0
+        self.reload_errors = 0
+        self.last_reload = None
+        self.last_reload_duration = None
+        self.last_error = None
+
+        self._stamp = None
         if filepath:
             # open and load json list of authorized service URNs
             try:
-                with open(filepath,'r') as f:
-                    self.urn_list =  json.load(f)
-                    print(f'*** Loaded service validation list {filepath}',file=sys.stderr)
+                self._stamp = self._file_stamp(filepath)
+                self._compiled = self._load(filepath)
+                print(f'*** Loaded service validation list {filepath}',file=sys.stderr)
 
             except Exception as e:
                 # specified file could either not be open and read or the json loaded
                 print(f'ERROR: Exception in init_service_urn for file "{filepath}": {str(e)}', file=sys.stderr)
                 raise e
 
+            if reload_interval:
+                # watch for changes to the list
+                watcher = threading.Thread(
+                    target=self._watch,
+                    args=(reload_interval,),
+                    name=f'URNmanager-watch:{filepath}',
+                    daemon=True
+                )
+                watcher.start()
+
+
+    @property
+    def urn_list(self):
+        """ The currently loaded list (None - all services permitted). """
+
+        return self._compiled[0]
+
+
+    def _file_stamp(self, filepath):
+        """ Signature of the file used to detect changes. """
+
+        st = os.stat(filepath)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+    def _load(self, filepath):
+        """ Read and compile the list - returns (urn_list, matcher). """
+
+        with open(filepath,'r') as f:
+            urn_list = json.load(f)
+
+        if not isinstance(urn_list, list):
+            raise ValueError('service list must be a JSON list')
+
+        return (urn_list, URNmatcher(urn_list))
+
+
+    def reload(self, force=False):
+        """ Reload the list if the file changed - returns True if reloaded. """
+
+        if not self.filepath:
+            return False
+
+        try:
+            stamp = self._file_stamp(self.filepath)
+            if not force and stamp == self._stamp:
+                return False
+
+            # a bad file is only retried once it changes again
+            self._stamp = stamp
+
+            started = time.perf_counter()
+            compiled = self._load(self.filepath)
+
+            # atomic swap - requests in flight keep the list they started with
+            self._compiled = compiled
+
+            self.last_reload_duration = time.perf_counter() - started
+            self.last_reload = time.time()
+            self.reload_count += 1
+            print(f'*** Reloaded service validation list {self.filepath} ({len(compiled[0])} entries)', file=sys.stderr)
+            return True
+
+        except Exception as e:
+            # keep serving the list we have
+            self.reload_errors += 1
+            self.last_error = str(e)
+            print(f'ERROR: Exception reloading "{self.filepath}": {str(e)}', file=sys.stderr)
+            return False
+
+
+    def _watch(self, interval):
+        """ Poll the file for changes (runs on the watcher thread). """
+
+        while True:
+            time.sleep(interval)
+            self.reload()
+
+
+    def reload_stats(self):
+        """ Reload counters and timings. """
+
+        return {
+            'filepath': self.filepath,
+            'entries': len(self.urn_list) if self.urn_list is not None else None,
+            'reload_count': self.reload_count,
+            'reload_errors': self.reload_errors,
+            'last_reload': self.last_reload,
+            'last_reload_duration': self.last_reload_duration,
+            'last_error': self.last_error,
+        }
+
+
+    def stats(self):
+        """ Numeric reload counters and timings (metrics). """
+
+        return {
+            'entries': len(self.urn_list) if self.urn_list is not None else None,
+            'reloads': self.reload_count,
+            'reload_errors': self.reload_errors,
+            'last_reload': self.last_reload,
+            'last_reload_duration': self.last_reload_duration,
+        }
+
 
     def valid(self, service):
         """ Validate a service is on the approved list. """
 
-        if service and self.urn_list:
+        urn_list, matcher = self._compiled
+
+        if service and urn_list:
             # Find matching service
-            for aservice in self.urn_list:
-                if self.match(aservice, service):
-                    return service
+            if matcher.match(service):
+                return service
         else:
             # promiscuous approval of service
             return service
 
         # service is not authorized
         return None
-    
+
 
     def match(self, standard_urn, test_urn):
         """ Compare the test_urn against the standard_urn. """
 
         # case insensitive match
-        standard = standard_urn.lower()
-        test = test_urn.lower()
+        standard = fold(standard_urn)
+        test = fold(test_urn)
 
         # match if the test_urn begins with the stadard_urn
         #  - this allows subtree URLs and querystrings in the service
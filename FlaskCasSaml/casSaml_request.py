@@ -1,9 +1,12 @@
 """
 CAS SAML response
 """
+import calendar
 import datetime
+import re
 import time
 from uuid import uuid4
+from xml.parsers import expat
 from flask import request
 
 import defusedxml.ElementTree as ElementTree
@@ -15,6 +18,19 @@ TIMEFMT = '%Y-%m-%dT%H:%M:%S%z'
 
 SLOP_TIME = 10      # 10 sec for time skew
 MAX_AGE = 1*60*60   # We don't process requests older than one houre.
+MAX_REQUEST_SIZE = 16*1024  # samlValidate requests are well under 1KB
+
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+SAMLP_NS = 'urn:oasis:names:tc:SAML:1.0:protocol'
+
+# expat names with namespace_separator=' '
+SOAP_BODY = SOAP_NS + ' Body'
+SAMLP_REQUEST = SAMLP_NS + ' Request'
+SAMLP_ARTIFACT = SAMLP_NS + ' AssertionArtifact'
+
+ISO8601 = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?'
+    r'(Z|[+-]\d\d:?\d\d)$')
 
 unixnow = lambda : time.time()
 utc_now_saml = lambda : datetime.datetime.strftime(datetime.datetime.utcnow(),TIMEFMTFRAC) + 'Z'
@@ -29,6 +45,38 @@ def getsamltime(tstring):
     return datetime.datetime.strptime(tstring,format).timestamp()
 
 
+def parse_iso8601(tstring):
+    """ Return Unix time for ISO string (getsamltime without strptime). """
+
+    m = ISO8601.match(tstring)
+    if m is None:
+        raise ValueError(f'time data {tstring!r} is not ISO 8601')
+
+    year, month, day, hour, minute, second, frac, zone = m.groups()
+    fields = (int(year), int(month), int(day), int(hour), int(minute), int(second))
+    fraction = int(frac[:6].ljust(6, '0')) / 1e6 if frac else 0.0
+
+    # validates ranges the way strptime would
+    datetime.datetime(*fields)
+
+    stamp = calendar.timegm(fields) + fraction
+    if zone != 'Z':
+        sign = -1 if zone[0] == '+' else 1
+        zone = zone[1:].replace(':', '')
+        stamp += sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+    return stamp
+
+
+class SamlRequestFound(Exception):
+    """ The parser has everything it needs - stop. """
+
+
+def forbidden(*args):
+    """ expat handler for DTDs and entity declarations. """
+
+    raise ValueError('DTDs and entities are not allowed in samlValidate requests')
+
+
 class CASSamlRequest:
     """Process SAML1.1 Validation Request."""
 
@@ -72,29 +120,113 @@ class CASSamlRequest:
         return True
 
 
+def parse_saml_request(method, target, raw_xml):
+    """ Checked samlValidate request - returns (target, ticket). """
+
+    if method != 'POST':
+        raise Exception('POST method is required for this endPoint')
+
+    if target is None:
+        raise Exception('TARGET URN is required')
+
+    if not raw_xml:
+        raise Exception('XML Body is required')
+
+    if len(raw_xml) > MAX_REQUEST_SIZE:
+        raise Exception('XML Body too large')
+        
+    xml = StreamingSamlRequest(raw_xml)
+    xml.is_valid_request()
+
+    return target, xml.ticket
+
+
+class StreamingSamlRequest(CASSamlRequest):
+    """Process SAML1.1 Validation Request - streaming parse.
+
+    Parses with expat (no DTDs, entities or external references) and
+    stops as soon as the Request attributes and AssertionArtifact are
+    read, without building a tree.
+    """
+
+    def __init__(self, xml):
+
+        self.max_age = MAX_AGE
+        self.request = None
+        self.ticket = None
+        self._path = []
+        self._text = None
+
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.StartDoctypeDeclHandler = forbidden
+        parser.EntityDeclHandler = forbidden
+        parser.UnparsedEntityDeclHandler = forbidden
+        parser.ExternalEntityRefHandler = forbidden
+        parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._chars
+        parser.buffer_text = True
+
+        try:
+            parser.Parse(xml, True)
+        except SamlRequestFound:
+            pass
+
+        xreq = self.request
+        assert xreq, 'Could not find xml Request'
+        assert self.ticket is not None, 'Could not find xml AssertionArtifact'
+
+        self.request_issue_instant = parse_iso8601(xreq['IssueInstant'])
+        self.request_version = f'{xreq["MajorVersion"]}.{xreq["MinorVersion"]}'
+        self.request_id = xreq['RequestID']
+
+    def _start(self, name, attrs):
+
+        path = self._path
+        if name == SAMLP_REQUEST and self.request is None and len(path) == 2 and path[1] == SOAP_BODY:
+            self.request = attrs
+        elif name == SAMLP_ARTIFACT and self.request is not None and path[1:] == [SOAP_BODY, SAMLP_REQUEST]:
+            self._text = []
+        elif self._text is not None:
+            # element inside the artifact - .text ends here
+            self._finish()
+        path.append(name)
+
+    def _chars(self, data):
+
+        if self._text is not None and self._path[-1] == SAMLP_ARTIFACT:
+            self._text.append(data)
+
+    def _end(self, name):
+
+        self._path.pop()
+        if name == SAMLP_ARTIFACT and self._text is not None:
+            self._finish()
+
+    def _finish(self):
+
+        self.ticket = ''.join(self._text).strip()
+        raise SamlRequestFound()
+
+
 # route: /cas/samlValidate - [POST] REST XML response
 def cas_v3_samlValidate(self):
     """ CAS v3 /cas/samlValidate - backchannel service_ticket validation (SAML1.1 response). """
 
     try:
-        if request.method != 'POST':
-            raise Exception('POST method is required for this endPoint')
-
-        target = request.args.get('TARGET', None)
-        if target is None:
-            raise Exception('TARGET URN is required')
+        if (request.content_length or 0) > MAX_REQUEST_SIZE:
+            # refuse before reading the body
+            raise Exception('XML Body too large')
 
-        raw_xml = request.get_data()
-        if not raw_xml:
-            raise Exception('XML Body is required')
-            
-        xml = CASSamlRequest(raw_xml.decode('utf-8'))
-        xml.is_valid_request()
+        target, ticket = parse_saml_request(
+            request.method, request.args.get('TARGET', None), request.get_data())
 
-        (status, reason, service_ticket) = self.validate_ticket(ticket=xml.ticket, service=target)
+        (status, reason, service_ticket) = self.validate_ticket(ticket=ticket, service=target)
 
         if status == 'OK':
-            return CASResponse.saml_success(service_ticket, life_time=self.cas_tgt_life)
+            with self.metrics.timer('cas_render_seconds', response='samlValidate'):
+                return CASResponse.saml_success(service_ticket, life_time=self.cas_tgt_life)
         else:
             raise Exception(f'{status} : {reason}')
 
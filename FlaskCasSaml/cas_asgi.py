@@ -0,0 +1,411 @@
+"""
+    Bottle CAS Server - asyncio (ASGI) back-channel endpoints
+
+    Service validation, proxy and samlValidate endpoints as a plain ASGI
+    application, for deployments where validators and pgtUrl callbacks
+    should not each hold a worker thread. Browser login/logout stays with
+    CasBridge; both must use the same ticket store.
+
+        from FlaskCasSaml.cas_asgi import AsyncCasBridge
+        app = AsyncCasBridge(config=cas_config)     # uvicorn module:app
+"""
+import json
+import os
+import time
+from urllib.parse import parse_qs, unquote
+
+import jinja2
+
+from .AsyncTicketStore import async_ticket_store, ThreadedTicketStore
+from .CasTicketManager import CasTicketManager
+from .CasMetrics import InstrumentedAsyncTicketStore
+from .ProxyCallback import AsyncProxyCallbackClient
+from .casSaml_request import parse_saml_request, MAX_REQUEST_SIZE
+from .cas_response import (
+    CASResponse,
+    FragmentCache,
+    attributes_fragment,
+    auth_success_json,
+    failure_json,
+    proxy_success_json,
+    saml_success_context,
+    saml_failure_context,
+)
+from .cas_xml import (
+    auth_success_xml,
+    auth_failure_xml,
+    proxy_success_xml,
+    proxy_failure_xml,
+    saml_success_xml,
+)
+
+TEMPLATES = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__), 'views')),
+    autoescape=True,
+)
+
+# same caching headers as CAS_common
+NO_CACHE = [
+    (b'cache-control', b'no-store no-cache'),
+    (b'pragma', b'no-cache'),
+    (b'expires', b'-1'),
+]
+
+
+class AsyncCasBridge(CasTicketManager):
+    """ CAS back-channel endpoints as an ASGI application.
+
+    config - as for CasBridge
+    db - TicketStore (or cachelib cache) shared with the CasBridge; if None
+         the cas_ticket_store config is used (natively async for redis)
+    astore - explicit async ticket store
+    tgt_cache - the CasBridge's tgt_cache, so its logouts drop our cached TGT/PGT's
+    """
+
+    def __init__(self, config={}, db=None, astore=None, tgt_cache=None):
+
+        # A CasBridge sharing the store logs users out; without its cache (or pubsub)
+        # those invalidations never reach ours - don't cache unless told to
+        if tgt_cache is not None or (
+                db is not None
+                and not config.get('cas_tgt_cache_pubsub', None)
+                and config.get('cas_tgt_cache_ttl', None) is None):
+            config = dict(config, cas_tgt_cache_ttl=0)
+
+        if astore is None:
+            astore = async_ticket_store(config, db)
+        if db is None and isinstance(astore, ThreadedTicketStore):
+            db = astore.store
+
+        super().__init__(auth=None, config=config, db=db)
+        if tgt_cache is not None:
+            self.tgt_cache = tgt_cache
+
+        # store latency as the event loop sees it
+        self.astore = InstrumentedAsyncTicketStore(astore, self.metrics) if self.metrics.enabled else astore
+        self.apgt_client = AsyncProxyCallbackClient(config)
+
+        # Cache serialized attributes for the life of a TGT (0 - disabled)
+        fragment_cache_size = config.get('cas_attribute_cache_size', 1024)
+        if fragment_cache_size and CASResponse.fragment_cache is None:
+            CASResponse.fragment_cache = FragmentCache(fragment_cache_size, self.cas_tgt_life)
+
+        self.routes = {
+            '/cas/validate': self.cas_v1_validate,
+            '/cas/serviceValidate': self.cas_v2_serviceValidate,
+            '/cas/p3/serviceValidate': self.cas_v2_serviceValidate,
+            '/cas/samlValidate': (
+                self.cas_v3_samlValidate if self.cas_samlValidate_support else self.notimplemented),
+        }
+        for path, handler in (
+                ('/cas/proxyValidate', self.cas_v2_proxyValidate),
+                ('/cas/p3/proxyValidate', self.cas_v2_proxyValidate),
+                ('/cas/proxy', self.cas_v2_proxy)):
+            self.routes[path] = handler if self.cas_proxy_support else self.notimplemented
+
+        if self.metrics.enabled and config.get('cas_metrics_route', True):
+            self.routes['/cas/metrics'] = self.cas_metrics
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path'].rstrip('/') or '/'
+        handler = self.routes.get(path)
+        if handler is None:
+            return await self.respond(send, 'Not Found', 'text/plain', status=404)
+
+        started = time.perf_counter()
+        args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        # handlers return (body, content type[, status])
+        await self.respond(send, *await handler(scope, receive, args))
+
+        if self.metrics.enabled:
+            self.metrics.observe(
+                'cas_request_seconds', time.perf_counter() - started, endpoint=path)
+
+    async def lifespan(self, receive, send):
+        """ ASGI startup/shutdown. """
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.apgt_client.aclose()
+                await self.astore.aclose()
+                self.audit.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, body, content_type, status=200):
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type.encode('latin-1'))] + NO_CACHE,
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    async def read_body(receive):
+        """ Request body (bounded by MAX_REQUEST_SIZE). """
+
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_REQUEST_SIZE:
+                raise Exception('XML Body too large')
+        return body
+
+#
+# ASYNC TICKET OPERATIONS - the async counterparts of CasTicketManager I/O
+#
+    async def aclaim_ticket(self, service_ticket):
+        """ Claim a service or proxy ticket. """
+
+        if self.signer and self.signer.is_signed(service_ticket):
+            ticket = await self.aclaim_signed_ticket(service_ticket)
+            if ticket is None:
+                return self.ticket_not_found(service_ticket)
+        else:
+            ticket = await self.astore.claim(service_ticket) if service_ticket else None
+            if not ticket:
+                return self.ticket_not_found(service_ticket)
+            ticket = self.codec.decode(ticket)
+
+        if 'details' not in ticket and 'details_ref' in ticket:
+            attrs = await self.astore.get(ticket['details_ref'])
+            if attrs is None:
+                return self.attributes_expired(service_ticket)
+            ticket['details'] = self.codec.decode(attrs)
+
+        return ticket
+
+    async def aclaim_signed_ticket(self, service_ticket):
+        """ Content of a genuine, unspent signed ticket or None. """
+
+        opened = self.signer.open(service_ticket)
+        if opened is None:
+            return None
+
+        granting_ticket = await self.alookup_granting_ticket(opened['granted_by'])
+        if granting_ticket is None or not await self.astore.add(opened['spent_key'], '1', opened['spent_life']):
+            return None
+
+        return self.ticket_content(granting_ticket, opened['service'], opened['proxy'], opened['renewed'])
+
+    async def asave_ticket(self, key, ticket, life):
+        """ Save a ticket descended from a TGT - indexed under the TGT for logout. """
+
+        blob = self.codec.encode(ticket)
+        root = ticket.get('tgt')
+
+        if self.cas_logout_revoke and root:
+            await self.astore.set_indexed(key, blob, life, 'tgtIdx:' + root)
+        else:
+            await self.astore.set(key, blob, life)
+
+    async def alookup_granting_ticket(self, tgt):
+        """ Retrieve a granting ticket (TGT or PGT) or None - don't modify it. """
+
+        if self.tgt_cache:
+            ticket = self.tgt_cache.get(tgt)
+            if ticket is not None:
+                return ticket
+
+        ticket_data = await self.astore.get(tgt)
+        if not ticket_data:
+            return None
+
+        ticket = self.codec.decode(ticket_data)
+        if self.tgt_cache:
+            self.tgt_cache.put(tgt, ticket)
+        return ticket
+
+    async def aissue_pgt_ticket(self, pgturl, st_ticket):
+        """ Create a Proxy Granting Ticket. """
+
+        if pgturl is None:
+            return None
+
+        proxy_ticket, pgtiou = self.new_pgt_ids(st_ticket.get('tgt'))
+
+        ok, reason = await self.apgt_client.callback(pgturl, proxy_ticket, pgtiou)
+        if not ok:
+            self.audit.emit('pgt_callback_failed', user=st_ticket['username'], pgturl=pgturl, reason=reason)
+            return None
+
+        pgt_ticket = self.build_pgt_ticket(pgturl, st_ticket)
+
+        if 'details_ref' in pgt_ticket:
+            # refresh the shared record's lifetime to cover this pgt
+            await self.astore.set(
+                pgt_ticket['details_ref'],
+                self.codec.encode(st_ticket['details']),
+                max(self.cas_tgt_life, self.cas_pgt_life))
+
+        await self.asave_ticket(proxy_ticket, pgt_ticket, self.cas_pgt_life)
+        await self.astore.index_add('sessPGT:' + st_ticket['username'], proxy_ticket, self.cas_pgt_life)
+
+        return pgtiou
+
+    async def avalidate_ticket(self, args, ticket=None, service=None, proxysok=False):
+        """ Validate a service or proxy ticket. """
+
+        started = time.perf_counter()
+
+        if ticket is None:
+            ticket = args.get('ticket')
+
+        if service is None:
+            service = args.get('service')
+
+        pgturl = args.get('pgtUrl')
+
+        # always claim the ticket - one shot at validation
+        service_ticket = await self.aclaim_ticket(ticket)
+
+        status, reason = self.check_ticket(
+            ticket, service, service_ticket, pgturl, args.get('renew'), proxysok)
+
+        pgtiou = None
+        if status == 'OK':
+            pgtiou = await self.aissue_pgt_ticket(pgturl, service_ticket)
+            status, reason = self.check_pgtiou(
+                status, reason, ticket, pgturl, pgtiou, service_ticket)
+
+        self.metrics.inc('cas_validation_total', status=status)
+        self.audit.emit(
+            'validate',
+            status=status,
+            user=service_ticket.get('username'),
+            service=service,
+            ticket=ticket,
+            pgt=pgtiou is not None,
+            reason=reason,
+            duration=time.perf_counter() - started,
+        )
+
+        return (status, reason, service_ticket)
+
+#
+# CAS PROTOCOL ENDPOINTS - handlers return (body, content type)
+#
+    async def cas_v1_validate(self, scope, receive, args):
+        """ CAS V1 /cas/validate - back-channel service ticket validation. """
+
+        (status, reason, service_ticket) = await self.avalidate_ticket(args, proxysok=False)
+
+        if status == 'OK':
+            return f'yes\n{service_ticket["username"]}\n', 'text/plain'
+        return 'no\n', 'text/plain'
+
+    async def cas_v2_proxyValidate(self, scope, receive, args):
+        """ CAS V2/V3 /cas/{p3/}proxyValidate - backchannel service ticket validation. """
+
+        return await self.cas_v2_serviceValidate(scope, receive, args, proxysok=self.cas_proxy_support)
+
+    async def cas_v2_serviceValidate(self, scope, receive, args, proxysok=False):
+        """ CAS V2/V3 /cas/{p3/}serviceValidate - backchannel service ticket validation. """
+
+        (status, reason, service_ticket) = await self.avalidate_ticket(args, proxysok=proxysok)
+
+        if args.get('format') == 'JSON':
+            if status == 'OK':
+                return auth_success_json(service_ticket), 'application/json'
+            return json.dumps(failure_json('authenticationFailure', status, reason)), 'application/json'
+
+        if status == 'OK':
+            return auth_success_xml(
+                service_ticket, attributes_fragment(service_ticket, 'xml')), 'application/xml'
+        return auth_failure_xml(status, reason), 'application/xml'
+
+    async def cas_v2_proxy(self, scope, receive, args):
+        """ CAS V2/V3 /cas/proxy - Issue Proxy Ticket, return pgtiou. """
+
+        target_service = args.get('targetService')
+        pgt = args.get('pgt')
+
+        if target_service:
+            target_service = unquote(target_service)
+
+        error, message = self.check_proxy_request(pgt, target_service)
+
+        if not error:
+            pgt_ticket = await self.alookup_granting_ticket(pgt)
+            if pgt_ticket:
+                # PGT is valid - issue a pt for target_service
+                proxy_ticket = self.signed_ticket(pgt_ticket, target_service, proxy=True, granted_by=pgt)
+                if not proxy_ticket:
+                    proxy_ticket, new_ticket = self.build_ticket(pgt_ticket, target_service, proxy=True)
+                    await self.asave_ticket(proxy_ticket, new_ticket, self.cas_service_ticket_life)
+
+                self.audit.emit(
+                    'proxy_issued', user=pgt_ticket['username'], service=target_service, ticket=proxy_ticket)
+
+                if args.get('format') == 'JSON':
+                    return json.dumps(proxy_success_json(proxy_ticket)), 'application/json'
+                return proxy_success_xml(proxy_ticket), 'application/xml'
+
+            # PGT is not found
+            error = 'INVALID_TICKET'
+            message = f'Proxy Grant Ticket {pgt} is Invalid.'
+
+        self.audit.emit(
+            'proxy_failed', status=error, service=target_service, pgt=pgt, path=scope['path'], reason=message)
+
+        if args.get('format') == 'JSON':
+            return json.dumps(failure_json('proxyFailure', error, message)), 'application/json'
+        return proxy_failure_xml(error, message), 'application/xml'
+
+    async def cas_v3_samlValidate(self, scope, receive, args):
+        """ CAS v3 /cas/samlValidate - backchannel service_ticket validation (SAML1.1 response). """
+
+        try:
+            target, ticket = parse_saml_request(
+                scope['method'], args.get('TARGET', None), await self.read_body(receive))
+
+            (status, reason, service_ticket) = await self.avalidate_ticket(
+                args, ticket=ticket, service=target)
+
+            if status != 'OK':
+                raise Exception(f'{status} : {reason}')
+
+            context = saml_success_context(service_ticket, self.cas_tgt_life)
+            return saml_success_xml(
+                service_ticket,
+                context['issue_instant'],
+                context['expires_after'],
+                context['auth_instant'],
+                context['response_id'],
+                attributes_fragment(service_ticket, 'saml'),
+            ), 'application/xml'
+
+        except Exception as e:
+            return TEMPLATES.get_template('v3_cas_saml_error.xml').render(
+                **saml_failure_context(str(e))), 'application/xml'
+
+    async def cas_metrics(self, scope, receive, args):
+        """ /cas/metrics - Prometheus text format. """
+
+        client = scope.get('client')
+        if not self.metrics_access.allowed(client[0] if client else None):
+            return 'Forbidden', 'text/plain', 403
+
+        return self.metrics.render(), 'text/plain'
+
+    async def notimplemented(self, scope, receive, args):
+        """ Unimplemented or Disabled Functionality """
+
+        return 'Unimplemented', 'text/html'
@@ -1,15 +1,59 @@
-import datetime
+import hashlib
 import json
+import math
+import threading
 import time
+from collections import OrderedDict
 from uuid import uuid4
 
 from flask import request, Response, render_template
 
+# defined here before the move to cas_xml - re-exported for existing importers
+from .cas_xml import xml_escape, xml_unescape  # noqa: F401
+from .cas_xml import (
+    xml_markup,
+    attributes_xml,
+    saml_attributes_xml,
+    saml_success_xml,
+    saml_success_chunks,
+    auth_success_xml,
+    auth_failure_xml,
+    proxy_success_xml,
+    proxy_failure_xml,
+)
+
 TIMEFMTFRAC = '%Y-%m-%dT%H:%M:%S.%f%z'
 TIMEFMT = '%Y-%m-%dT%H:%M:%S%z'
 SLOP_TIME = 10      # 10 sec for time skew
 
-saml_date = lambda utime : datetime.datetime.utcfromtimestamp(utime).strftime(TIMEFMTFRAC) + 'Z'
+_saml_second = (None, '')     # (unix second, its formatted date and time)
+
+
+def saml_date(utime):
+    """ SAML timestamp (TIMEFMTFRAC + 'Z') for a Unix time.
+
+    The date and time are formatted once per second; only the microseconds
+    change between calls.
+    """
+
+    global _saml_second
+
+    # rounded as datetime.utcfromtimestamp() does
+    frac, whole = math.modf(utime)
+    micro = round(frac * 1e6)
+    if micro >= 1000000:
+        whole, micro = whole + 1, micro - 1000000
+    elif micro < 0:
+        whole, micro = whole - 1, micro + 1000000
+
+    second, formatted = _saml_second
+    if second != whole:
+        formatted = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(whole))
+        _saml_second = (whole, formatted)
+
+    return f'{formatted}.{micro:06d}Z'
+
+
 utc_now_saml = lambda delta=0 : saml_date(time.time() + delta) 
 new_request_id = lambda : '_id' + str(uuid4())
 
@@ -20,86 +64,211 @@ def requested_json():
     return request.args.get('format') == 'JSON'
 
 
-def xml_escape(xml):
-    """ Escape XML Characters. """
+class FragmentCache:
+    """ LRU cache, with TTL, of serialized attribute fragments. """
+
+    def __init__(self, size=1024, ttl=8*60*60):
+
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires, fragment)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Cached fragment for key or None. """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, fragment):
+        """ Cache fragment under key. """
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, fragment)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+FRAGMENT_BUILDERS = {
+    'json': json.dumps,
+    'xml': attributes_xml,
+    'saml': saml_attributes_xml,
+}
+
+
+def attributes_fragment(service_ticket, fmt):
+    """ Serialized attributes of a ticket ('xml', 'saml' or 'json'), cached by digest. """
 
-    xml = xml.replace('&','&amp;')
-    xml = xml.replace('"','&quote;')
-    xml = xml.replace('\`','&apos;')
-    xml = xml.replace('>','&gt;')
-    xml = xml.replace('<','&lt;')
-    return xml
+    details = service_ticket.get('details')
+    build = FRAGMENT_BUILDERS[fmt]
 
+    if fmt != 'json' and not details:
+        # no <cas:attributes> block / <Attribute> elements at all
+        return ''
 
-def xml_unescape(xml):
-    """ UnEscape XML Characters. """
+    cache = CASResponse.fragment_cache
+    if cache is None:
+        return build(details)
+
+    digest = service_ticket.get('details_digest')
+    if digest is None:
+        if fmt == 'json':
+            # the digest would cost as much as the fragment
+            return build(details)
+        digest = hashlib.blake2b(json.dumps(details).encode('utf-8'), digest_size=16).hexdigest()
+
+    key = (fmt, digest)
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = build(details)
+        cache.put(key, fragment)
+
+    return fragment
+
+
+def auth_success_json(service_ticket):
+    """ serviceValidate success as JSON text. """
+
+    # splice the per-ticket fields around the attributes fragment
+    auth = [
+        '{"serviceResponse": {"authenticationSuccess": {"user": ',
+        json.dumps(service_ticket.get('username')),
+        ', "attributes": ',
+        attributes_fragment(service_ticket, 'json'),
+    ]
+
+    pgtiou = service_ticket.get('pgtiou')
+    if pgtiou:
+        auth += [', "proxyGrantingTicket": ', json.dumps(pgtiou)]
+    
+    is_proxy_ticket = service_ticket.get('is_proxy_ticket')
+    proxies = service_ticket.get('proxies')
+    
+    if is_proxy_ticket and proxies:
+        auth += [', "proxies": ', json.dumps(proxies)]
+
+    auth.append('}}}')
     
-    xml = xml.replace('&amp;', '&')
-    xml = xml.replace('&quote;','"')
-    xml = xml.replace('&apos;', '\`')
-    xml = xml.replace('&gt;', '>')
-    xml = xml.replace('&lt;', '<')
-    return xml  
+    return ''.join(auth)
+
+
+def failure_json(kind, error, message):
+    """ authenticationFailure/proxyFailure as a JSON object. """
+
+    return {
+        "serviceResponse":{
+            kind :{
+                "code" : error,
+                "description": message,
+            }
+        }
+    }
+
+
+def proxy_success_json(proxy_ticket):
+    """ proxySuccess as a JSON object. """
+
+    return {
+        "serviceResponse":{
+            "proxySuccess" :{
+                "proxyTicket": proxy_ticket,
+            }
+        }
+    }
+
+
+def saml_success_context(service_ticket, life_time):
+    """ v3_cas_saml_success.xml template variables. """
+
+    now = time.time()
+    issue_instant = saml_date(now)
+
+    if 'authenticated' in service_ticket['details']:
+        auth_instant = saml_date(int(service_ticket['details']['authenticated']))
+    else: # we lie.
+        auth_instant = issue_instant
+
+    return dict(
+        issue_instant = issue_instant,
+        expires_after = saml_date(now + life_time),
+        auth_instant = auth_instant,
+        response_id = new_request_id(),
+        service_ticket = service_ticket,
+        xmlesc = xml_markup,
+    )
+
+
+def saml_failure_context(message):
+    """ v3_cas_saml_error.xml template variables. """
+
+    return dict(
+        status_code = 'Requestor',
+        status_message = message,
+        issue_instant = utc_now_saml(),
+        response_id = new_request_id(),
+        xmlesc = xml_markup
+    )
 
 
 class CASResponse:
     """ CAS-specific response routines. """
 
+    # render v2 responses from the templates rather than cas_xml
+    use_templates = False
+
+    # FragmentCache for attribute serializations (None - disabled)
+    fragment_cache = None
+
+    # send samlValidate success bodies as a stream of chunks
+    saml_stream = False
+
     @staticmethod
     def auth_success(service_ticket):
         """ Respond to /cas/serviceValidate pr /cas/proxyValidate succeeded """
 
         if requested_json():
-            auth = {
-                'user' : service_ticket.get('username'),
-                'attributes': service_ticket.get('details'),
-            }
-            
-            pgtiou = service_ticket.get('pgtiou')
-            if pgtiou:
-                auth['proxyGrantingTicket'] = pgtiou
-            
-            is_proxy_ticket = service_ticket.get('is_proxy_ticket')
-            proxies = service_ticket.get('proxies')
-            
-            if is_proxy_ticket and proxies:
-                auth['proxies'] = proxies
-            
-            return CAS_common().asJSON({
-                "serviceResponse":{
-                    "authenticationSuccess" : auth,
-                }
-            })
+            return CAS_common().asJSONtext(auth_success_json(service_ticket))
         
-        else: # XML
+        elif CASResponse.use_templates:
             return CAS_common().asXML(render_template(
                     'v2_auth_success.xml', 
                     service_ticket=service_ticket,
-                    xmlesc=xml_escape
+                    xmlesc=xml_markup
                 ))
 
+        else: # XML
+            return CAS_common().asXML(auth_success_xml(
+                service_ticket,
+                attributes_fragment(service_ticket, 'xml')
+            ))
+
 
     @staticmethod
     def auth_failure(error, message):
         """ Respond to /cas/serviceValidate or /cas/proxyValidate failed """
         
         if requested_json():
-            return CAS_common().asJSON({
-                "serviceResponse":{
-                    "authenticationFailure" :{
-                        "code" : error,
-                        "description": message,
-                    }
-                }
-            })
+            return CAS_common().asJSON(failure_json('authenticationFailure', error, message))
 
-        else: # XML
+        elif CASResponse.use_templates:
             return CAS_common().asXML(render_template(
                 'v2_auth_failure.xml', 
                 error=error,
                 message=message,
-                xmlesc=xml_escape
+                xmlesc=xml_markup
             ))
+
+        else: # XML
+            return CAS_common().asXML(auth_failure_xml(error, message))
   
     
     @staticmethod
@@ -107,63 +276,60 @@ class CASResponse:
         """ Respond to /cas/proxy succeeded """
 
         if requested_json():
-            return CAS_common().asJSON({
-                "serviceResponse":{
-                    "proxySuccess" :{
-                        "proxyTicket": proxy_ticket,
-                    }
-                }
-            })
+            return CAS_common().asJSON(proxy_success_json(proxy_ticket))
 
-        else: # XML
+        elif CASResponse.use_templates:
             return CAS_common().asXML(render_template(
                 'v2_proxy_success.xml', 
                 proxy_ticket=proxy_ticket,
-                xmlesc=xml_escape
+                xmlesc=xml_markup
             ))
 
+        else: # XML
+            return CAS_common().asXML(proxy_success_xml(proxy_ticket))
+
     
     @staticmethod
     def proxy_failure(error, message):
         """ Respond to /cas/proxy failed """
 
         if requested_json():
-            return CAS_common().asJSON({
-                "serviceResponse":{
-                    "proxyFailure" :{
-                        "code" : error,
-                        "description": message,
-                    }
-                }
-            })
+            return CAS_common().asJSON(failure_json('proxyFailure', error, message))
 
-        else: # XML
+        elif CASResponse.use_templates:
             return CAS_common().asXML(render_template(
                 'v2_proxy_failure.xml', error=error, 
-                message=xml_escape(message)
+                message=message,
+                xmlesc=xml_markup
             ))
 
+        else: # XML
+            return CAS_common().asXML(proxy_failure_xml(error, message))
+
 
     @staticmethod
     def saml_success(service_ticket, life_time):
         """ Respond to v3 samlValidate success """
         
-        if 'authenticated' in service_ticket['details']:
-            auth_instant = saml_date(int(service_ticket['details']['authenticated']))
-        else: # we lie.
-            auth_instant = utc_now_saml()
-
-        # Build reply with data from the service_ticket
-        dat = render_template( 'v3_cas_saml_success.xml',
-                issue_instant = utc_now_saml(),
-                expires_after = utc_now_saml(life_time),
-                auth_instant = auth_instant,
-                response_id = new_request_id(),
-                service_ticket = service_ticket,
-                xmlesc = xml_escape,
-            )
-        
-        return CAS_common().asXML(dat)
+        context = saml_success_context(service_ticket, life_time)
+
+        if CASResponse.use_templates:
+            # Build reply with data from the service_ticket
+            return CAS_common().asXML(render_template('v3_cas_saml_success.xml', **context))
+
+        fields = (
+            service_ticket,
+            context['issue_instant'],
+            context['expires_after'],
+            context['auth_instant'],
+            context['response_id'],
+            attributes_fragment(service_ticket, 'saml'),
+        )
+
+        if CASResponse.saml_stream:
+            return CAS_common().asXMLstream(saml_success_chunks(*fields))
+
+        return CAS_common().asXML(saml_success_xml(*fields))
 
 
     @staticmethod
@@ -171,12 +337,7 @@ class CASResponse:
         """ Respond to SamlValidate error. """
 
         return CAS_common().asXML(render_template('v3_cas_saml_error.xml', 
-                status_code = 'Requestor',
-                status_message = xml_escape(message),
-                issue_instant = utc_now_saml(),
-                response_id = new_request_id()
-            )
-        )
+                **saml_failure_context(message)))
 
 
     @staticmethod
@@ -220,6 +381,14 @@ class CAS_common(Response):
         self.data = xml
         return self
 
+    def asXMLstream(self, chunks):
+        """ as XML, streamed from an iterable of byte chunks """
+
+        self.headers['Content-Type'] = 'application/xml'
+        self.headers.pop('Content-Length', None)
+        self.response = chunks
+        return self
+
     def asHTML(self, html):
         """ as HTML """
 
@@ -242,3 +411,10 @@ class CAS_common(Response):
         self.headers['Content-Type'] = 'application/json'
         self.data = json.dumps(js)
         return self
+
+    def asJSONtext(self, js):
+        """ as JSON already serialized """
+
+        self.headers['Content-Type'] = 'application/json'
+        self.data = js
+        return self
@@ -2,10 +2,11 @@
     Bottle CAS Server - APIs
 """
 from crypt import methods
+import time
 from urllib.parse import unquote, parse_qs, urlencode
 
 from flask import (
-    current_app,
+    g,
     url_for,
     request, 
     render_template, 
@@ -14,8 +15,11 @@ from flask import (
     session
 )
 
-from .cas_response import CASResponse
+from .cas_response import CASResponse, FragmentCache
 from .CasTicketManager import CasTicketManager
+from .TicketStore import ticket_store_from_config
+from .RequestProfiler import RequestProfiler
+from .CasMetrics import stats_collector
 from .casSaml_request import cas_v3_samlValidate
 
 
@@ -35,6 +39,9 @@ class CasBridge(CasTicketManager, Blueprint):
         if 'backing' in kwargs:
             # user specified different backing store for tickets
             backing = kwargs['backing']
+        elif config.get('cas_ticket_store'):
+            # dedicated ticket store (memory/redis/sqlite)
+            backing = ticket_store_from_config(config['cas_ticket_store'])
         else:
             # use the backing store from flask-session for tickets
             backing = app.session_interface.cache
@@ -42,6 +49,18 @@ class CasBridge(CasTicketManager, Blueprint):
         # Initialize CAS Ticket manager
         super().__init__(auth=auth, config=config, db=backing)
 
+        # Render v2 XML responses from the templates (def: built directly)
+        CASResponse.use_templates = config.get('cas_response_templates', False)
+
+        # Stream samlValidate success responses (def: single body)
+        CASResponse.saml_stream = config.get('cas_saml_stream', False)
+
+        # Cache serialized attributes for the life of a TGT (0 - disabled)
+        fragment_cache_size = config.get('cas_attribute_cache_size', 1024)
+        CASResponse.fragment_cache = FragmentCache(
+            fragment_cache_size, self.cas_tgt_life
+        ) if fragment_cache_size else None
+
         Blueprint.__init__(self,template_folder='./views', name='cas', import_name=__name__)
 
         # protocol routes - CAS protocol spec specifies /cas prefix in API
@@ -120,6 +139,35 @@ class CasBridge(CasTicketManager, Blueprint):
                 view_func=self.notimplemented
             )
 
+        # cProfile this fraction of /cas requests (def: None - disabled)
+        profile_rate = config.get('cas_profile_rate', None)
+        self.profiler = None
+        if profile_rate:
+            self.profiler = RequestProfiler(
+                config.get('cas_profile_dir', './cas_profiles'),
+                profile_rate,
+                config.get('cas_profile_interval', 300),
+                config.get('cas_profile_keep', 48),
+            )
+            self.before_request(self.start_profile)
+            self.after_request(self.finish_profile)
+            self.teardown_request(self.abandon_profile)
+            self.metrics.add_collector(stats_collector(
+                'cas_profiler', self.profiler, counters=('sampled', 'skipped', 'dumps')))
+
+        if self.metrics.enabled:
+            # per-endpoint latency
+            self.before_request(self.start_request_timer)
+            self.after_request(self.record_request_timer)
+
+            # Prometheus scrape endpoint (def: enabled with metrics)
+            if config.get('cas_metrics_route', True):
+                self.add_url_rule(
+                    '/cas/metrics',
+                    endpoint='metrics',
+                    view_func=self.cas_metrics
+                )
+
         # niceness routes - go to login page
         # self.add_url_rule('/cas/<anything>', view_func=self.default_route)
         self.add_url_rule('/cas', view_func=self.default_route)
@@ -133,6 +181,59 @@ class CasBridge(CasTicketManager, Blueprint):
         """ Process V3 samlValidate """
         return cas_v3_samlValidate(self)
 
+    # before_request (metrics enabled)
+    def start_request_timer(self):
+
+        g.cas_request_started = time.perf_counter()
+
+
+    # after_request (metrics enabled)
+    def record_request_timer(self, response):
+
+        started = g.pop('cas_request_started', None)
+        if started is not None and request.url_rule is not None:
+            self.metrics.observe(
+                'cas_request_seconds',
+                time.perf_counter() - started,
+                endpoint=request.url_rule.rule
+            )
+        return response
+
+
+    # before_request (profiling enabled)
+    def start_profile(self):
+
+        profile = self.profiler.start()
+        if profile is not None:
+            g.cas_profile = profile
+
+
+    # after_request (profiling enabled)
+    def finish_profile(self, response):
+
+        profile = g.pop('cas_profile', None)
+        if profile is not None:
+            # tagged by validation/proxy status where there is one, else HTTP status
+            self.profiler.finish(
+                profile,
+                request.url_rule.rule if request.url_rule is not None else request.path,
+                g.get('cas_outcome') or response.status_code
+            )
+        return response
+
+
+    # teardown_request (profiling enabled)
+    def abandon_profile(self, exc):
+        """ Stop a profile after_request never saw (an unhandled exception). """
+
+        profile = g.pop('cas_profile', None)
+        if profile is not None:
+            self.profiler.finish(
+                profile,
+                request.url_rule.rule if request.url_rule is not None else request.path,
+                'exception'
+            )
+
 #
 # CAS PROTOCOL ENDPOINTS
 #
@@ -141,32 +242,33 @@ class CasBridge(CasTicketManager, Blueprint):
         """ CAS V1/v2/v3 login Require TGT or initiate auth login. """
 
         reauth = request.args.get('renew','false') == 'true'
-        kwargs['force_reauth'] = reauth
 
-        try:
-            tg_ticket = self.lookup_granting_ticket(session.get(self.CAS_TGT))
+        if not reauth:
+            # SSO - most logins already hold a TGT (usually in the TGT cache)
+            try:
+                tg_ticket = self.lookup_granting_ticket(session.get(self.CAS_TGT))
 
-        except Exception as e:
-            tg_ticket = None
+            except Exception as e:
+                tg_ticket = None
 
-        if tg_ticket and not reauth:
-            # good ticket - get to work
-            return self.do_cas_login(tg_ticket) 
+            if tg_ticket:
+                # good ticket - get to work
+                return self.do_cas_login(tg_ticket)
 
-        else:
-            # 'renew' or not authenticated - initiate login
-            session[self.CAS_LOGGING_IN] = True
+        # 'renew' or not authenticated - initiate login
+        kwargs['force_reauth'] = reauth
+        session[self.CAS_LOGGING_IN] = True
 
-            # remove 'renew' from querystring
-            qsdict = parse_qs(request.query_string)
-            if 'renew' in qsdict: del qsdict['renew']
+        # remove 'renew' from querystring
+        qsdict = parse_qs(request.query_string)
+        if 'renew' in qsdict: del qsdict['renew']
 
-            ## rebuild URL
-            url = request.url.split('?')[0]
-            if qsdict: 
-                url = url +  '?' + urlencode(qsdict,doseq=True)
-            
-            return self.auth.initiate_login(*args, next=url, **kwargs)
+        ## rebuild URL
+        url = request.url.split('?')[0]
+        if qsdict: 
+            url = url +  '?' + urlencode(qsdict,doseq=True)
+        
+        return self.auth.initiate_login(*args, next=url, **kwargs)
 
 
     # login real work
@@ -176,26 +278,29 @@ class CasBridge(CasTicketManager, Blueprint):
         service = request.args.get('service')
 
         if service:
-            # Service Ticket is Requested
-            service = unquote(service) + '?'
-            service_base = service.split('?')[0]
-            query_string = service.split('?')[1]
+            # Service Ticket is Requested - split the service URL once
+            service_base, _, query_string = unquote(service).partition('?')
 
             if not self.service_list.valid(service_base):
                 msg = f'Invalid service requested:  "{service_base}" is not authorized.'
-                current_app.logger.info(f'CAS: {msg}')
+                self.audit.emit('service_rejected', user=tg_ticket['username'], service=service_base, reason=msg)
                 return CASResponse.auth_failure('INVALID_SERVICE', msg)
             
             # for 'renew' checks on serviceValidate
             creds_presented = session.get(self.FRESH_CREDENTIALS, False)
-            session[self.FRESH_CREDENTIALS] = False
+            if creds_presented:
+                # only then is the session modified (and rewritten)
+                session[self.FRESH_CREDENTIALS] = False
 
             # Issue service ticket and redirect to service.
             service_ticket = self.issue_ticket(tg_ticket, service_base, renewed=creds_presented)
             
-            user = tg_ticket['username']
-            current_app.logger.info(
-                f'CAS: "{user}" issued service ticket {service_ticket} for "{service_base}"'
+            self.audit.emit(
+                'ticket_issued',
+                user=tg_ticket['username'],
+                service=service_base,
+                ticket=service_ticket,
+                renewed=creds_presented
             )
 
             # redirect to service with ticket
@@ -222,18 +327,17 @@ class CasBridge(CasTicketManager, Blueprint):
 
         tgt = session.get(self.CAS_TGT)
         username = session.get('USERNAME')
+        count, elapsed = None, 0.0
         
         if tgt:
-            # remove any associated pgts
-            self.destroy_pgts(username)
-            # remove this tgt 
-            self.db.delete(tgt)
+            # remove this tgt, its st/pt/pgt's and the user's pgts
+            count, elapsed = self.revoke_granting_ticket(tgt, username)
             del session[self.CAS_TGT]
 
         # Log off ends our session
         session.clear()
 
-        current_app.logger.info(f'CAS: user "{username}" logged out')
+        self.audit.emit('logout', user=username, tgt=tgt, revoked=count, duration=elapsed)
         
         # next URL for logout - redirect
         service = request.args.get('service')
@@ -278,12 +382,13 @@ class CasBridge(CasTicketManager, Blueprint):
 
         (status, reason, service_ticket) = self.validate_ticket(proxysok=proxysok)
 
-        if status == 'OK':
-            # Build reply with data from the service_ticket
-            return CASResponse.auth_success(service_ticket)
-        else:
-            # Build error message
-            return CASResponse.auth_failure(status, reason)
+        with self.metrics.timer('cas_render_seconds', response='serviceValidate'):
+            if status == 'OK':
+                # Build reply with data from the service_ticket
+                return CASResponse.auth_success(service_ticket)
+            else:
+                # Build error message
+                return CASResponse.auth_failure(status, reason)
 
 
     # route: /cas/proxy - REST XML/JSON response
@@ -292,52 +397,52 @@ class CasBridge(CasTicketManager, Blueprint):
 
         target_service = request.args.get('targetService')
         pgt = request.args.get('pgt')
-        error = None
-        
-        if not self.cas_proxy_support:
-            error='INVALID_REQUEST'
-            message='Proxy support disabled on this server.'
-        
-        elif pgt and target_service:
-            # pgt and target_service are required parameters for /cas/proxy
-            target_service = unquote(target_service)
-
-            if not self.service_list.valid(target_service):
-                # Service is not permitted
-                error='INVALID_SERVICE'
-                message = f'Invalid proxy service request {target_service}'
 
-            elif not pgt.startswith('PGT-'):
-                error='INVALID_TICKET'
-                message=f'{pgt} is not a Proxy Grant Ticket'
-            
-            else:   
-                # get the granting ticket detail
-                pgt_ticket = self.lookup_proxy_granting_ticket(pgt)
-                if pgt_ticket:
-                    # PGT is valid - issue a pt for target_service       
-                    proxy_ticket = self.issue_ticket(pgt_ticket, target_service, proxy=True)
-
-                    user = pgt_ticket['username']
-                    current_app.logger.info(f'CAS: "{user}" issued proxy ticket {proxy_ticket} for "{target_service}"')
-                    
-                    # return pt success
-                    return CASResponse.proxy_success(proxy_ticket) 
-
-                else:
-                    # PGT is not found
-                    error='INVALID_TICKET'
-                    message=f'Proxy Grant Ticket {pgt} is Invalid.'
-                    
-        else:
-            # Missing pgt or targetService
-            error = 'INVALID_REQUEST'
-            message='Both a pgt and targetService is required.'
+        if target_service:
+            target_service = unquote(target_service)
 
-        current_app.logger.info(f'CAS: Error "{error}" on Proxy request {request.url} : "{message}"')
+        error, message = self.check_proxy_request(pgt, target_service)
+
+        if not error:
+            # get the granting ticket detail
+            pgt_ticket = self.lookup_proxy_granting_ticket(pgt)
+            if pgt_ticket:
+                # PGT is valid - issue a pt for target_service       
+                proxy_ticket = self.issue_ticket(pgt_ticket, target_service, proxy=True, granted_by=pgt)
+
+                g.cas_outcome = 'OK'
+                self.audit.emit(
+                    'proxy_issued',
+                    user=pgt_ticket['username'],
+                    service=target_service,
+                    ticket=proxy_ticket
+                )
+                
+                # return pt success
+                with self.metrics.timer('cas_render_seconds', response='proxy'):
+                    return CASResponse.proxy_success(proxy_ticket)
+
+            # PGT is not found
+            error='INVALID_TICKET'
+            message=f'Proxy Grant Ticket {pgt} is Invalid.'
+
+        self.audit.emit(
+            'proxy_failed', status=error, service=target_service, pgt=pgt, path=request.url, reason=message)
+        g.cas_outcome = error
         
         # return pt failure
-        return CASResponse.proxy_failure(error, message)
+        with self.metrics.timer('cas_render_seconds', response='proxy'):
+            return CASResponse.proxy_failure(error, message)
+
+
+    # route: /cas/metrics - Prometheus text format
+    def cas_metrics(self):
+        """ Latency histograms, validation counters and store/cache gauges. """
+
+        if not self.metrics_access.allowed(request.remote_addr):
+            return 'Forbidden', 403
+
+        return CASResponse.legacy_txt(self.metrics.render())
 
 
     # route: /cas/<unimplemented> - any service configured out or not implemented
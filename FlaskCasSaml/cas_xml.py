@@ -0,0 +1,259 @@
+"""
+    Bottle CAS Server - CAS 2/3 XML serializers
+
+    Builds the same documents as the v2_*.xml and v3_cas_saml_success.xml
+    templates without a template render per request. Output must stay
+    identical to the templates, which remain available with the
+    cas_response_templates option.
+"""
+import re
+from string import Formatter
+
+from markupsafe import Markup
+
+
+# entity table - '&' must be first
+XML_ESCAPES = (
+    ('&', '&amp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ('"', '&quot;'),
+    ("'", '&apos;'),
+)
+XML_ENTITIES = {entity[1:-1]: char for char, entity in XML_ESCAPES}
+XML_ENTITIES['quote'] = '"'     # written by earlier releases
+XML_ENTITY = re.compile(r'&(amp|lt|gt|quot|quote|apos);')
+
+
+def xml_escape(xml):
+    """ Escape XML Characters. """
+
+    # most values need no escaping - a scan for each character is far
+    # cheaper than rebuilding the string
+    if '&' in xml or '<' in xml or '>' in xml or '"' in xml or "'" in xml:
+        for char, entity in XML_ESCAPES:
+            xml = xml.replace(char, entity)
+    return xml
+
+
+def xml_unescape(xml):
+    """ UnEscape XML Characters. """
+
+    if '&' not in xml:
+        return xml
+    return XML_ENTITY.sub(lambda m: XML_ENTITIES[m.group(1)], xml)
+
+
+def esc(value):
+    """ Escape any value for XML text or attribute content. """
+
+    return xml_escape(value if isinstance(value, str) else str(value))
+
+
+def xml_markup(value):
+    """ Template helper - escaped once, and marked safe from autoescape. """
+
+    return Markup(esc(value))
+
+
+def is_multi_valued(value):
+    """ Template 'v is iterable and v is not string'. """
+
+    return not isinstance(value, str) and hasattr(value, '__iter__')
+
+
+CAS_HEAD = '<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">\n'
+CAS_TAIL = '</cas:serviceResponse>'
+
+
+def attributes_xml(details):
+    """ <cas:attributes> block for a details dict. """
+
+    parts = ['<cas:attributes>\n']
+    for k, v in details.items():
+        tag = esc(k)
+        for vv in (v if is_multi_valued(v) else (v,)):
+            parts.append(f' <cas:{tag}>{esc(vv)}</cas:{tag}>\n')
+    parts.append(' </cas:attributes>')
+    return ''.join(parts)
+
+
+def auth_success_xml(service_ticket, attributes=None):
+    """ v2_auth_success.xml (attributes - prebuilt attributes_xml fragment) """
+
+    parts = [
+        CAS_HEAD,
+        '<cas:authenticationSuccess>\n',
+        f'<cas:user>{esc(service_ticket.get("username"))}</cas:user>\n',
+    ]
+
+    if attributes is None:
+        details = service_ticket.get('details')
+        attributes = attributes_xml(details) if details else ''
+    parts.append(attributes)
+
+    pgtiou = service_ticket.get('pgtiou')
+    if pgtiou:
+        parts.append(f'\n<cas:proxyGrantingTicket>{esc(pgtiou)}</cas:proxyGrantingTicket>\n')
+
+    if service_ticket.get('is_proxy_ticket'):
+        parts.append('<cas:proxies>\n')
+        for proxy in service_ticket.get('proxies') or ():
+            parts.append(f'<cas:proxy>{esc(proxy)}</cas:proxy>\n')
+        parts.append('</cas:proxies>\n')
+
+    parts.append('</cas:authenticationSuccess>\n')
+    parts.append(CAS_TAIL)
+    return ''.join(parts)
+
+
+def auth_failure_xml(error, message):
+    """ v2_auth_failure.xml """
+
+    return (
+        f'{CAS_HEAD}<cas:authenticationFailure code="{esc(error)}">\n'
+        f'{esc(message)}\n'
+        f'</cas:authenticationFailure>\n{CAS_TAIL}'
+    )
+
+
+def proxy_success_xml(proxy_ticket):
+    """ v2_proxy_success.xml """
+
+    return (
+        f'{CAS_HEAD}<cas:proxySuccess>\n'
+        f'<cas:proxyTicket>{esc(proxy_ticket)}</cas:proxyTicket>\n'
+        f'</cas:proxySuccess>\n{CAS_TAIL}'
+    )
+
+
+def proxy_failure_xml(error, message):
+    """ v2_proxy_failure.xml """
+
+    return (
+        f'{CAS_HEAD}<cas:proxyFailure code="{esc(error)}">\n'
+        f'{esc(message)}\n'
+        f'</cas:proxyFailure>\n{CAS_TAIL}'
+    )
+
+
+#
+# SAML 1.1 samlValidate success - v3_cas_saml_success.xml
+#
+CAS_ATTRIBUTE_NS = 'http://www.ja-sig.org/products/cas/'
+
+SAML_SUCCESS = '''<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+  <SOAP-ENV:Header />
+  <SOAP-ENV:Body>
+    <Response xmlns="urn:oasis:names:tc:SAML:1.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:1.0:assertion"
+    xmlns:samlp="urn:oasis:names:tc:SAML:1.0:protocol" xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" IssueInstant="{issue_instant}"
+    MajorVersion="1" MinorVersion="1" Recipient="{service}" ResponseID="{response_id}">
+      <Status>
+        <StatusCode Value="samlp:Success"></StatusCode>
+      </Status>
+      <Assertion xmlns="urn:oasis:names:tc:SAML:1.0:assertion" AssertionID="{response_id}"
+      IssueInstant="{issue_instant}" Issuer="localhost" MajorVersion="1" MinorVersion="1">
+        <Conditions NotBefore="{issue_instant}" NotOnOrAfter="{expires_after}">
+          <AudienceRestrictionCondition>
+            <Audience>{service}</Audience>
+          </AudienceRestrictionCondition>
+        </Conditions>
+        <AttributeStatement>
+          <Subject>
+            <NameIdentifier>{username}</NameIdentifier>
+            <SubjectConfirmation>
+              <ConfirmationMethod>urn:oasis:names:tc:SAML:1.0:cm:artifact</ConfirmationMethod>
+            </SubjectConfirmation>
+          </Subject>{attributes}
+          <Attribute AttributeName="isFromNewLogin" AttributeNamespace="http://www.ja-sig.org/products/cas/">
+            <AttributeValue>{new_login}</AttributeValue>
+          </Attribute>
+          <Attribute AttributeName="authenticationDate" AttributeNamespace="http://www.ja-sig.org/products/cas/">
+            <AttributeValue>{auth_instant}</AttributeValue>
+          </Attribute>       
+      </AttributeStatement>
+        <AuthenticationStatement AuthenticationInstant="{auth_instant}" AuthenticationMethod="urn:oasis:names:tc:SAML:1.0:am:password">
+          <Subject>
+            <NameIdentifier>{username}</NameIdentifier>
+            <SubjectConfirmation>
+              <ConfirmationMethod>urn:oasis:names:tc:SAML:1.0:cm:artifact</ConfirmationMethod>
+            </SubjectConfirmation>
+          </Subject>
+        </AuthenticationStatement>
+      </Assertion>
+    </Response>
+  </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>'''
+
+
+def compile_skeleton(skeleton):
+    """ [(static text, static bytes, field name or None)] for a {field} skeleton. """
+
+    return [
+        (text, text.encode('utf-8'), field)
+        for text, field, _, _ in Formatter().parse(skeleton)
+    ]
+
+
+SAML_SUCCESS_CHUNKS = compile_skeleton(SAML_SUCCESS)
+
+
+def saml_attributes_xml(details):
+    """ <Attribute> elements for a details dict. """
+
+    parts = []
+    for k, v in details.items():
+        parts.append(f'\n          <Attribute AttributeName="{esc(k)}" AttributeNamespace="{CAS_ATTRIBUTE_NS}">')
+        for vv in (v if is_multi_valued(v) else (v,)):
+            parts.append(f'\n            <AttributeValue>{esc(vv)}</AttributeValue>')
+        parts.append('\n          </Attribute>')
+    return ''.join(parts)
+
+
+def saml_success_fields(service_ticket, issue_instant, expires_after, auth_instant,
+        response_id, attributes=None):
+    """ Escaped values for the SAML_SUCCESS fields. """
+
+    if attributes is None:
+        attributes = saml_attributes_xml(service_ticket.get('details') or {})
+
+    return {
+        'issue_instant': esc(issue_instant),
+        'expires_after': esc(expires_after),
+        'auth_instant': esc(auth_instant),
+        'response_id': esc(response_id),
+        'service': esc(service_ticket.get('service', '')),
+        'username': esc(service_ticket.get('username', '')),
+        'new_login': 'true' if service_ticket.get('creds_presented') else 'false',
+        'attributes': attributes,
+    }
+
+
+def saml_success_xml(service_ticket, issue_instant, expires_after, auth_instant,
+        response_id, attributes=None):
+    """ v3_cas_saml_success.xml (attributes - prebuilt saml_attributes_xml fragment) """
+
+    fields = saml_success_fields(
+        service_ticket, issue_instant, expires_after, auth_instant, response_id, attributes)
+
+    parts = []
+    for text, _, field in SAML_SUCCESS_CHUNKS:
+        parts.append(text)
+        if field:
+            parts.append(fields[field])
+    return ''.join(parts)
+
+
+def saml_success_chunks(service_ticket, issue_instant, expires_after, auth_instant,
+        response_id, attributes=None):
+    """ saml_success_xml as a generator of byte chunks. """
+
+    fields = saml_success_fields(
+        service_ticket, issue_instant, expires_after, auth_instant, response_id, attributes)
+
+    for _, chunk, field in SAML_SUCCESS_CHUNKS:
+        yield chunk
+        if field:
+            yield fields[field].encode('utf-8')
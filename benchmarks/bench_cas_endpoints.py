@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+    Load test: CAS protocol endpoints
+
+    Drives a CasBridge through the Flask test client (in process) or a real
+    threaded WSGI server over HTTP. A stub auth provider stands in for
+    FlaskSaml and a local HTTP server answers pgtUrl callbacks, so no IdP
+    or network services are needed.
+
+    Scenarios (timed request in brackets):
+        login               [/cas/login with a TGT -> ST redirect]
+        serviceValidate     [/cas/serviceValidate]
+        serviceValidateJSON [/cas/serviceValidate?format=JSON]
+        proxyValidate       [/cas/proxyValidate with a pgtUrl callback]
+        proxy               [/cas/proxy - PT issued from a PGT]
+        samlValidate        [POST /cas/samlValidate]
+        logout              [/cas/logout of a session holding an ST]
+
+    python benchmarks/bench_cas_endpoints.py [--driver client|server]
+        [--concurrency N] [--requests N] [--attrs N] [--values N]
+        [--store simple|memory|sqlite|sharded[:N]|redis://...] [--config JSON]
+        [--scenario NAME ...] [--json FILE] [--baseline FILE]
+
+    --json saves the results with the commit they were taken at; --baseline
+    prints the change against an earlier --json file.
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import requests
+from flask import Flask, redirect, session
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from FlaskCasSaml import CasBridge
+
+
+SERVICE = 'https://app.example.com/bench/'
+PROXIED_SERVICE = 'https://backend.example.com/api/'
+
+SAML_REQUEST = (
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<SOAP-ENV:Header/><SOAP-ENV:Body><samlp:Request xmlns:samlp="urn:oasis:names:tc:SAML:1.0:protocol"'
+    ' MajorVersion="1" MinorVersion="1" RequestID="_bench" IssueInstant="{instant}">'
+    '<samlp:AssertionArtifact>{ticket}</samlp:AssertionArtifact>'
+    '</samlp:Request></SOAP-ENV:Body></SOAP-ENV:Envelope>'
+)
+
+
+#
+# STUBS - authentication provider and pgtUrl callback receiver
+#
+class StubAuth:
+    """ Stands in for FlaskSaml - /stublogin authenticates at once. """
+
+    def __init__(self, app, attrs, values):
+
+        self.hooks = []
+        self.attrs = attrs
+        self.values = values
+        app.add_url_rule('/stublogin', 'stublogin', self.finish)
+
+    def add_login_hook(self, hook):
+        self.hooks.append(hook)
+
+    def initiate_login(self, next=None, force_reauth=False, **kwargs):
+
+        session['next'] = next
+        return redirect('/stublogin')
+
+    def finish(self):
+
+        username = session.get('bench_user', 'bench')
+        attrs = {'uid': username, 'mail': f'{username}@example.com'}
+        for n in range(self.attrs):
+            attrs[f'attr{n}'] = [f'{username} value {v} <&>' for v in range(self.values)]
+
+        session['USERNAME'] = username
+        for hook in self.hooks:
+            hook(username, attrs)
+        return redirect(session.pop('next'))
+
+
+class PgtReceiver(http.server.ThreadingHTTPServer):
+    """ pgtUrl callback endpoint - remembers pgtIou -> pgtId. """
+
+    daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            args = parse_qs(urlsplit(self.path).query)
+            if 'pgtIou' in args:
+                self.server.pgts[args['pgtIou'][0]] = args['pgtId'][0]
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.pgts = {}
+        threading.Thread(target=self.serve_forever, name='bench-pgt', daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/pgtCallback'
+
+
+#
+# DRIVERS - one per worker, each with its own cookie jar
+#
+class ClientDriver:
+    """ Flask test client - no sockets, measures the application alone. """
+
+    def __init__(self, app):
+
+        self.app = app
+        self.reset()
+
+    def reset(self):
+        self.client = self.app.test_client()
+
+    def get(self, path, params=None):
+
+        r = self.client.get(path, query_string=params)
+        return r.status_code, r.headers.get('Location', ''), r.get_data()
+
+    def post(self, path, params=None, data=None):
+
+        r = self.client.post(path, query_string=params, data=data, content_type='text/xml')
+        return r.status_code, r.headers.get('Location', ''), r.get_data()
+
+
+class ServerDriver:
+    """ requests session against the threaded WSGI server. """
+
+    def __init__(self, base_url):
+
+        self.base_url = base_url
+        self.http = requests.Session()
+
+    def reset(self):
+        self.http.cookies.clear()
+
+    def get(self, path, params=None):
+
+        r = self.http.get(self.base_url + path, params=params, allow_redirects=False)
+        return r.status_code, r.headers.get('Location', ''), r.content
+
+    def post(self, path, params=None, data=None):
+
+        r = self.http.post(
+            self.base_url + path, params=params, data=data,
+            headers={'Content-Type': 'text/xml'}, allow_redirects=False)
+        return r.status_code, r.headers.get('Location', ''), r.content
+
+
+#
+# WORKER - protocol steps shared by the scenarios
+#
+class Worker:
+
+    def __init__(self, bench, n):
+
+        self.bench = bench
+        self.driver = bench.new_driver()
+        self.username = f'bench{n}'
+        self.pgt = None
+
+    def login(self):
+        """ Full login through the stub provider - leaves a TGT in the session. """
+
+        self.driver.reset()
+        status, location, _ = self.driver.get('/cas/login', {'bench_user': self.username})
+        while status in (301, 302, 303) and location:
+            url = urlsplit(location)
+            status, location, _ = self.driver.get(url.path + '?' + url.query)
+
+    def service_ticket(self, service=SERVICE):
+
+        status, location, _ = self.driver.get('/cas/login', {'service': service})
+        return parse_qs(urlsplit(location).query)['ticket'][0]
+
+    def granting_ticket(self):
+        """ PGT for this worker's session (via proxyValidate). """
+
+        if self.pgt is None:
+            _, _, body = self.driver.get('/cas/proxyValidate', {
+                'service': SERVICE, 'ticket': self.service_ticket(), 'pgtUrl': self.bench.pgt.url})
+            pgtiou = re.search(rb'<cas:proxyGrantingTicket>([^<]+)<', body).group(1).decode()
+            self.pgt = self.bench.pgt.pgts.pop(pgtiou)
+        return self.pgt
+
+
+def timed(request, *args, expect=b''):
+    """ (seconds, ok) for one request. """
+
+    started = time.perf_counter()
+    status, location, body = request(*args)
+    elapsed = time.perf_counter() - started
+    return elapsed, status < 400 and expect in (location.encode() + body)
+
+
+def sc_login(w):
+    return timed(w.driver.get, '/cas/login', {'service': SERVICE}, expect=b'ticket=ST-')
+
+
+def sc_service_validate(w):
+    return timed(w.driver.get, '/cas/serviceValidate',
+        {'service': SERVICE, 'ticket': w.service_ticket()}, expect=b'authenticationSuccess')
+
+
+def sc_service_validate_json(w):
+    return timed(w.driver.get, '/cas/serviceValidate',
+        {'service': SERVICE, 'ticket': w.service_ticket(), 'format': 'JSON'}, expect=b'authenticationSuccess')
+
+
+def sc_proxy_validate(w):
+    return timed(w.driver.get, '/cas/proxyValidate',
+        {'service': SERVICE, 'ticket': w.service_ticket(), 'pgtUrl': w.bench.pgt.url},
+        expect=b'proxyGrantingTicket')
+
+
+def sc_proxy(w):
+    return timed(w.driver.get, '/cas/proxy',
+        {'pgt': w.granting_ticket(), 'targetService': PROXIED_SERVICE}, expect=b'proxySuccess')
+
+
+def sc_saml_validate(w):
+
+    instant = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    body = SAML_REQUEST.format(instant=instant, ticket=w.service_ticket()).encode('utf-8')
+    return timed(w.driver.post, '/cas/samlValidate', {'TARGET': SERVICE}, body, expect=b'samlp:Success')
+
+
+def sc_logout(w):
+
+    w.login()
+    w.service_ticket()
+    return timed(w.driver.get, '/cas/logout', None, expect=b'')
+
+
+SCENARIOS = {
+    'login': sc_login,
+    'serviceValidate': sc_service_validate,
+    'serviceValidateJSON': sc_service_validate_json,
+    'proxyValidate': sc_proxy_validate,
+    'proxy': sc_proxy,
+    'samlValidate': sc_saml_validate,
+    'logout': sc_logout,
+}
+
+
+#
+# BENCH
+#
+class Bench:
+
+    def __init__(self, args):
+
+        self.args = args
+        self.pgt = PgtReceiver()
+
+        config = {
+            'cas_samlValidate': True,
+            'cas_proxy_support': True,
+            'verify_ssl': False,
+        }
+        kwargs = {}
+        if args.store == 'simple':
+            from cachelib import SimpleCache
+            kwargs['backing'] = SimpleCache(threshold=1000000)
+        elif args.store == 'memory':
+            config['cas_ticket_store'] = {'store_type': 'memory'}
+        elif args.store == 'sqlite':
+            self._tmp = tempfile.TemporaryDirectory()
+            config['cas_ticket_store'] = {
+                'store_type': 'sqlite', 'path': os.path.join(self._tmp.name, 'tickets.db')}
+        elif args.store.startswith('sharded'):
+            # N in-process memory stores standing in for cache nodes
+            count = int(args.store.partition(':')[2] or 4)
+            config['cas_ticket_store'] = {
+                'store_type': 'sharded', 'nodes': [{'store_type': 'memory'}] * count}
+        elif args.store.startswith('redis'):
+            config['cas_ticket_store'] = {'store_type': 'redis', 'url': args.store}
+        else:
+            raise SystemExit(f'unknown --store {args.store}')
+        config.update(json.loads(args.config))
+
+        self.app = Flask(__name__)
+        self.app.secret_key = 'bench'
+        self.app.before_request(self._bench_user)
+        auth = StubAuth(self.app, args.attrs, args.values)
+        self.cas = CasBridge(self.app, auth, config=config, **kwargs)
+
+        self.server = None
+        if args.driver == 'server':
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            # keep-alive, as a production server in front of the app would
+            WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+            self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+            threading.Thread(target=self.server.serve_forever, name='bench-wsgi', daemon=True).start()
+            self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    @staticmethod
+    def _bench_user():
+        """ The worker's username rides on its first /cas/login. """
+
+        from flask import request
+        if 'bench_user' in request.args:
+            session['bench_user'] = request.args['bench_user']
+
+    def new_driver(self):
+
+        if self.server is not None:
+            return ServerDriver(self.base_url)
+        return ClientDriver(self.app)
+
+    def run(self, name):
+        """ Run one scenario - returns its result dict. """
+
+        scenario = SCENARIOS[name]
+        workers = [Worker(self, n) for n in range(self.args.concurrency)]
+        for w in workers:
+            w.login()
+
+        # warm up - first requests pay for template compilation, connections
+        for w in workers:
+            scenario(w)
+
+        per_worker = max(1, self.args.requests // len(workers))
+
+        def drive(w):
+            return [scenario(w) for _ in range(per_worker)]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(len(workers)) as pool:
+            samples = [s for found in pool.map(drive, workers) for s in found]
+        wall = time.perf_counter() - started
+
+        latencies = sorted(elapsed for elapsed, _ in samples)
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for _, ok in samples if not ok),
+            'throughput': len(samples) / wall,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+    def close(self):
+
+        if self.server is not None:
+            self.server.shutdown()
+        self.pgt.shutdown()
+
+
+def percentile(ordered, q):
+    """ Nearest-rank percentile of an ordered list. """
+
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def git_commit():
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def change(now, then):
+    return f'{(now - then) / then * 100:+6.1f}%' if then else '      '
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--driver', choices=('client', 'server'), default='client',
+        help='Flask test client or a threaded WSGI server over HTTP')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent workers')
+    parser.add_argument('--requests', type=int, default=2000, help='timed requests per scenario')
+    parser.add_argument('--attrs', type=int, default=10, help='multi-valued attributes per user')
+    parser.add_argument('--values', type=int, default=5, help='values per attribute')
+    parser.add_argument('--store', default='simple', help='simple (cachelib), memory, sqlite, sharded[:N] (N memory nodes) or a redis:// url')
+    parser.add_argument('--config', default='{}', help='extra CasBridge config as JSON')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='run only these scenarios')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    bench = Bench(args)
+    results = {}
+    print(f'{"scenario":20s} {"requests":>8s} {"errors":>6s} {"req/s":>9s} {"mean ms":>8s} {"p50 ms":>8s} {"p99 ms":>8s}')
+    try:
+        for name in args.scenario or SCENARIOS:
+            r = results[name] = bench.run(name)
+            line = (f'{name:20s} {r["requests"]:8d} {r["errors"]:6d} {r["throughput"]:9.1f}'
+                    f' {r["mean_ms"]:8.3f} {r["p50_ms"]:8.3f} {r["p99_ms"]:8.3f}')
+            if name in baseline:
+                b = baseline[name]
+                line += (f'   req/s {change(r["throughput"], b["throughput"])}'
+                         f' p50 {change(r["p50_ms"], b["p50_ms"])} p99 {change(r["p99_ms"], b["p99_ms"])}')
+            print(line, flush=True)
+    finally:
+        bench.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'args': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
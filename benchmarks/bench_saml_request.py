@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+    Micro-benchmark: samlValidate request parsing
+
+    Compares CASSamlRequest (defusedxml tree + strptime) with the streaming
+    StreamingSamlRequest over request bodies as sent by common CAS clients.
+
+    python benchmarks/bench_saml_request.py [--number N]
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from FlaskCasSaml.casSaml_request import CASSamlRequest, StreamingSamlRequest
+
+
+NOW = datetime.datetime.utcnow()
+
+# Java CAS client (Saml11TicketValidator) - one line, millisecond instant
+JAVA_CLIENT = (
+    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<SOAP-ENV:Header/><SOAP-ENV:Body><samlp:Request xmlns:samlp="urn:oasis:names:tc:SAML:1.0:protocol"'
+    ' MajorVersion="1" MinorVersion="1" RequestID="_10.1.2.3.4816324723816254" IssueInstant="'
+    + NOW.strftime('%Y-%m-%dT%H:%M:%S.') + f'{NOW.microsecond // 1000:03d}Z">'
+    '<samlp:AssertionArtifact>ST-5-aXhV9dHqkPcyvO2Pb2BjXhGv0-cas01</samlp:AssertionArtifact>'
+    '</samlp:Request></SOAP-ENV:Body></SOAP-ENV:Envelope>'
+)
+
+# pretty printed, as sent by several scripting language clients
+PRETTY_CLIENT = f'''<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+  <SOAP-ENV:Header/>
+  <SOAP-ENV:Body>
+    <samlp:Request xmlns:samlp="urn:oasis:names:tc:SAML:1.0:protocol"
+        MajorVersion="1" MinorVersion="1"
+        RequestID="_e7c4bb6c-2a11-4b4a-9a25-0a5dbbb4e2a0"
+        IssueInstant="{NOW.strftime('%Y-%m-%dT%H:%M:%SZ')}">
+      <samlp:AssertionArtifact>
+        ST-qP3vG1c8u1bWbQdD2Xn7l1m3qv8yZ0rS4tU6wX8yZ0A
+      </samlp:AssertionArtifact>
+    </samlp:Request>
+  </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+'''
+
+BODIES = {'java client': JAVA_CLIENT, 'pretty printed': PRETTY_CLIENT}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='requests parsed per timing')
+    args = parser.parse_args()
+
+    for body_name, body in BODIES.items():
+        raw = body.encode('utf-8')
+        for name, parse in (
+                ('CASSamlRequest', lambda: CASSamlRequest(raw.decode('utf-8'))),
+                ('StreamingSamlRequest', lambda: StreamingSamlRequest(raw))):
+            best = min(timeit.repeat(parse, number=args.number, repeat=5))
+            print(f'{body_name:16s} {name:22s} {best / args.number * 1e6:7.1f} us/request')
+
+
+if __name__ == '__main__':
+    main()
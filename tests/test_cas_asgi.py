@@ -0,0 +1,99 @@
+"""
+    Bottle CAS Server - ASGI back-channel with a Flask front end
+"""
+import asyncio
+import http.server
+import threading
+
+import httpx
+import pytest
+from flask import Flask, session, redirect
+
+from FlaskCasSaml import CasBridge
+from FlaskCasSaml.TicketStore import MemoryTicketStore
+from FlaskCasSaml.cas_asgi import AsyncCasBridge
+
+SERVICE = 'https://svc.example.com/app'
+
+
+class StubAuth:
+    """ Logs in 'alice' without an IdP. """
+
+    def __init__(self, app):
+        self.hooks = []
+        app.add_url_rule('/stublogin', 'stublogin', self.finish)
+
+    def add_login_hook(self, hook):
+        self.hooks.append(hook)
+
+    def initiate_login(self, next=None, force_reauth=False, **kwargs):
+        session['next'] = next
+        return redirect('/stublogin')
+
+    def finish(self):
+        for hook in self.hooks:
+            hook('alice', {'uid': 'alice'})
+        return redirect(session['next'])
+
+
+class PgtHandler(http.server.BaseHTTPRequestHandler):
+    """ pgtUrl endpoint accepting every callback. """
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def pgt_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PgtHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/pgt'
+    server.shutdown()
+
+
+def login(client):
+    """ Service ticket from a browser login. """
+
+    response = client.get('/cas/login', query_string={'service': SERVICE})
+    while 'ticket=' not in response.headers['Location']:
+        response = client.get(response.headers['Location'])
+    return response.headers['Location'].split('ticket=')[1]
+
+
+@pytest.mark.parametrize('share_cache', [False, True])
+def test_flask_logout_revokes_pgt_at_async_proxy(pgt_url, share_cache):
+
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    cas = CasBridge(app, StubAuth(app), config={}, backing=MemoryTicketStore())
+    assert cas.tgt_cache is not None
+
+    acas = AsyncCasBridge(
+        config={}, db=cas.db, tgt_cache=cas.tgt_cache if share_cache else None)
+
+    client = app.test_client()
+
+    async def proxy(pgt):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=acas), base_url='http://cas') as ac:
+            response = await ac.get('/cas/proxy', params={'pgt': pgt, 'targetService': SERVICE})
+            return 'proxySuccess' in response.text
+
+    async def validate(ticket):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=acas), base_url='http://cas') as ac:
+            response = await ac.get(
+                '/cas/serviceValidate', params={'service': SERVICE, 'ticket': ticket, 'pgtUrl': pgt_url})
+            return 'authenticationSuccess' in response.text
+
+    assert asyncio.run(validate(login(client)))
+    pgt = cas.db.index_members('sessPGT:alice')[0]
+    assert asyncio.run(proxy(pgt))
+
+    client.get('/cas/logout')
+
+    assert cas.db.get(pgt) is None
+    assert not asyncio.run(proxy(pgt))